@@ -5,10 +5,15 @@ from PIL import Image
 import random
 from utils.logo_fetcher import fetch_logo, save_logo
 from utils.image_overlay import overlay_logo_on_product, pad_image_to_square
+from utils.product_inspector_sam import embed_product_images
+from utils import model_registry
 import tempfile
 
 st.set_page_config(page_title="Get INK'D", layout="wide")
 
+# Load SAM and rembg in the background while the page renders
+model_registry.start_warm_up()
+
 css_path = "assets/styles.css"
 if os.path.exists(css_path):
     with open(css_path) as f:
@@ -73,6 +78,9 @@ if generate_clicked and company_input:
                 if p.lower().endswith((".png", ".jpg", ".jpeg"))
             ]
 
+            # Embed the whole catalog in one encoder pass
+            embed_product_images(product_paths)
+
             st.session_state.mockup_paths = []
             for product_path in product_paths:
                 filename = os.path.basename(product_path)
@@ -4,12 +4,29 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from .build_sam import (
-    build_sam,
-    build_sam_vit_h,
-    build_sam_vit_l,
-    build_sam_vit_b,
-    sam_model_registry,
-)
-from .predictor import SamPredictor
-from .automatic_mask_generator import SamAutomaticMaskGenerator
+import importlib
+from typing import Any
+
+# Public names are imported on first access, so that torch-free modules such
+# as onnx_predictor can be used without importing torch.
+_LAZY_ATTRS = {
+    "build_sam": ".build_sam",
+    "build_sam_vit_h": ".build_sam",
+    "build_sam_vit_l": ".build_sam",
+    "build_sam_vit_b": ".build_sam",
+    "build_sam_vit_b_int8": ".build_sam",
+    "sam_model_registry": ".build_sam",
+    "ImageEmbedding": ".predictor",
+    "SamPredictor": ".predictor",
+    "SamAutomaticMaskGenerator": ".automatic_mask_generator",
+    "OnnxSamPredictor": ".onnx_predictor",
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name: str) -> Any:
+    if name in _LAZY_ATTRS:
+        module = importlib.import_module(_LAZY_ATTRS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -6,33 +6,46 @@
 
 import numpy as np
 import torch
-from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
+from torchvision.ops.boxes import batched_nms, box_area, box_iou  # type: ignore
 
-from typing import Any, Dict, List, Optional, Tuple
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 from .modeling import Sam
-from .predictor import SamPredictor
+from .predictor import ImageEmbedding, SamPredictor
 from .utils.amg import (
     MaskData,
-    area_from_rle,
     batch_iterator,
+    batched_mask_moments,
     batched_mask_to_box,
     box_xyxy_to_xywh,
     build_all_layer_point_grids,
+    build_foreground_point_grid,
+    build_point_grid,
     calculate_stability_score,
     coco_encode_rle,
+    estimate_foreground,
     generate_crop_boxes,
     is_box_near_crop_edge,
     mask_to_rle_pytorch,
-    remove_small_regions,
-    rle_to_mask,
+    pack_masks,
+    remove_small_regions_in_box,
+    remove_small_regions_packed,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
+    unpack_masks,
 )
 
 
 class SamAutomaticMaskGenerator:
+    # Number of (point grid, image size) pairs whose prompt embeddings are
+    # kept, and of image sizes whose crop boxes are
+    _POINT_PROMPTS_CACHE_SIZE = 16
+
     def __init__(
         self,
         model: Sam,
@@ -49,6 +62,12 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        low_res_filtering: bool = False,
+        point_sampling: str = "grid",
+        points_budget: int = 64,
+        adaptive_points_budget: Optional[int] = None,
+        memory_budget: Optional[int] = None,
+        crops_per_batch: Optional[int] = 4,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -90,9 +109,49 @@ class SamAutomaticMaskGenerator:
             to remove disconnected regions and holes in masks with area smaller
             than min_mask_region_area. Requires opencv.
           output_mode (str): The form masks are returned in. Can be 'binary_mask',
-            'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
-            For large resolutions, 'binary_mask' may consume large amounts of
-            memory.
+            'uncompressed_rle', 'coco_rle', or 'geometry'. 'coco_rle' requires
+            pycocotools. For large resolutions, 'binary_mask' may consume large
+            amounts of memory. 'geometry' returns no segmentation, only each
+            mask's box, area, centroid and central moments, calculated in batch
+            before the masks are discarded; with min_mask_region_area > 0
+            only the part of each mask within its box is kept, bit-packed,
+            until small regions have been removed.
+          low_res_filtering (bool): If true, masks are filtered by predicted
+            IoU and by a stability score calculated on the model's low
+            resolution (256x256) logits, and only the masks that pass are
+            upscaled to the image size. Much faster and lighter on memory
+            for large images; stability scores differ slightly from the
+            ones calculated at full resolution.
+          point_sampling (str): How point prompts are placed. 'grid' uses
+            the point grids above. 'foreground' places up to points_budget
+            points evenly over a cheap foreground estimate of each crop,
+            assuming an object on a light background, and falls back to
+            the grid if no foreground is found. Requires opencv. 'adaptive'
+            decodes grids of points_per_side/4, points_per_side/2 and
+            points_per_side points in turn, each time skipping points
+            already covered by an accepted mask, until every point is
+            covered or adaptive_points_budget points have been decoded.
+          points_budget (int): The maximum number of points per crop for
+            point_sampling='foreground'.
+          adaptive_points_budget (int or None): The maximum number of points
+            per crop for point_sampling='adaptive'. If None, the number of
+            points in the crop's grid, so no more points are decoded than
+            with point_sampling='grid'.
+          memory_budget (int or None): If given, the number of bytes the
+            masks of one batch may take up while they are upscaled,
+            thresholded and encoded. The number of points per batch is then
+            picked for each crop from its size, replacing points_per_batch,
+            so small images run in few large batches and large images don't
+            run out of memory. With low_res_filtering, batches keep
+            points_per_batch points, whose low res logits don't depend on
+            the image size, and the masks that pass the filters are instead
+            upscaled a few at a time; the results don't depend on the budget.
+          crops_per_batch (int or None): With crop_n_layers > 0, the number
+            of image crops run through the image encoder together. Each crop
+            needs about 1 GB of encoder memory with vit_b, and the
+            predictor keeps an input buffer for the largest batch. If None,
+            all crops of an image are encoded in a single batch, which is
+            fastest but needs encoder memory for every crop at once.
         """
 
         assert (points_per_side is None) != (
@@ -113,11 +172,20 @@ class SamAutomaticMaskGenerator:
             "binary_mask",
             "uncompressed_rle",
             "coco_rle",
+            "geometry",
         ], f"Unknown output_mode {output_mode}."
         if output_mode == "coco_rle":
             from pycocotools import mask as mask_utils  # type: ignore # noqa: F401
 
-        if min_mask_region_area > 0:
+        assert point_sampling in [
+            "grid",
+            "foreground",
+            "adaptive",
+        ], f"Unknown point_sampling {point_sampling}."
+        assert (
+            point_sampling != "adaptive" or points_per_side is not None
+        ), "point_sampling='adaptive' requires points_per_side."
+        if min_mask_region_area > 0 or point_sampling == "foreground":
             import cv2  # type: ignore # noqa: F401
 
         self.predictor = SamPredictor(model)
@@ -132,14 +200,37 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.low_res_filtering = low_res_filtering
+        self.point_sampling = point_sampling
+        self.points_budget = points_budget
+        self.adaptive_points_budget = adaptive_points_budget
+        self.memory_budget = memory_budget
+        self.crops_per_batch = crops_per_batch
+
+        # Per image size caches of everything that doesn't depend on pixels.
+        # The predictor is only used through embedding handles, so one
+        # generator can serve several threads; the lock guards the caches.
+        self._cache_lock = threading.Lock()
+        # Scratch tensors reused from batch to batch, one set per thread
+        self._buffers = threading.local()
+        self._crop_boxes_cache: "OrderedDict[Tuple[int, ...], Tuple[List[List[int]], List[int]]]"
+        self._crop_boxes_cache = OrderedDict()
+        self._point_prompts_cache: "OrderedDict[Tuple[Any, ...], Tuple[np.ndarray, torch.Tensor]]"
+        self._point_prompts_cache = OrderedDict()
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self, image: np.ndarray, embedding: Optional[ImageEmbedding] = None
+    ) -> List[Dict[str, Any]]:
         """
         Generates masks for the given image.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          embedding (ImageEmbedding or None): The image's embedding, e.g.
+            from SamPredictor.encode with the same model. If given, it is
+            used for the crop covering the whole image instead of running
+            the image encoder again.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
@@ -157,10 +248,16 @@ class SamAutomaticMaskGenerator:
                  is filtered on using the stability_score_thresh parameter.
                crop_box (list(float)): The crop of the image used to generate
                  the mask, given in XYWH format.
+             If output_mode='geometry', records have no segmentation and
+             instead contain:
+               centroid (list(float)): The mask's center of mass, in XY format.
+               central_moments (dict(str, float)): The second order central
+                 moments mu20, mu11 and mu02, as returned by cv2.moments.
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        mask_data = self._generate_masks(image, embedding)
+        self._release_buffers()
 
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
@@ -170,41 +267,163 @@ class SamAutomaticMaskGenerator:
                 max(self.box_nms_thresh, self.crop_nms_thresh),
             )
 
-        # Encode masks
-        if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
-        elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+        return self._mask_data_to_records(mask_data)
+
+    @torch.no_grad()
+    def generate_iter(
+        self,
+        image: np.ndarray,
+        predicate: Optional[Callable[[Dict[str, Any]], bool]] = None,
+        max_masks: Optional[int] = None,
+        embedding: Optional[ImageEmbedding] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Generates masks for the given image, yielding records as each batch
+        of points finishes instead of after the whole image. Stops as soon
+        as max_masks records have been yielded, or when the caller stops
+        iterating, so a caller looking for one acceptable mask doesn't pay
+        for the rest of the grid.
+
+        Duplicates are removed greedily in arrival order: a mask is dropped
+        if its box overlaps a mask already kept by more than box_nms_thresh
+        (crop_nms_thresh for masks from other crops). The set and order of
+        masks can therefore differ slightly from 'generate', which runs NMS
+        over each full crop.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          predicate (callable or None): If given, only records for which
+            predicate(record) is true are yielded and counted.
+          max_masks (int or None): The number of records after which to stop.
+          embedding (ImageEmbedding or None): The image's embedding, as
+            for 'generate'.
+
+        Returns:
+          (iterator(dict(str, any))): Mask records in the same format as
+            returned by 'generate'.
+        """
+        orig_size = image.shape[:2]
+        crop_boxes, layer_idxs = self._get_crop_boxes(orig_size)
+
+        # The first crop is the whole image, and often all that is needed.
+        # The other crops are encoded together once they are reached.
+        if embedding is not None:
+            self._check_embedding(embedding, orig_size)
+            embeddings = [embedding]
         else:
-            mask_data["segmentations"] = mask_data["rles"]
+            embeddings = self._encode_crops(image, crop_boxes[:1])
+
+        n_yielded = 0
+        # Boxes of the masks kept so far, from earlier crops and this one.
+        # They grow batch by batch, which MaskData.cat amortizes.
+        prev_crops_kept = MaskData(boxes=torch.zeros((0, 4)))
+        try:
+            for crop_idx, (crop_box, layer_idx) in enumerate(zip(crop_boxes, layer_idxs)):
+                if crop_idx == len(embeddings):
+                    embeddings += self._encode_crops(image, crop_boxes[crop_idx:])
+                crop_kept = MaskData(boxes=torch.zeros((0, 4)))
+                for data in self._iter_crop_batches(
+                    image, crop_box, layer_idx, orig_size, embeddings[crop_idx]
+                ):
+                    if len(data["iou_preds"]) == 0:
+                        continue
+
+                    # Remove duplicates within this batch
+                    keep_by_nms = batched_nms(
+                        data["boxes"].float(),
+                        data["iou_preds"],
+                        torch.zeros_like(data["boxes"][:, 0]),  # categories
+                        iou_threshold=self.box_nms_thresh,
+                    )
+                    data.filter(keep_by_nms)
+                    self._uncrop_data(data, crop_box)
+
+                    if self.min_mask_region_area > 0:
+                        data = self.postprocess_small_regions(
+                            data,
+                            self.min_mask_region_area,
+                            max(self.box_nms_thresh, self.crop_nms_thresh),
+                        )
+
+                    # Remove duplicates of masks kept from earlier batches and crops
+                    boxes = data["boxes"].float().cpu()
+                    keep_mask = torch.ones(len(boxes), dtype=torch.bool)
+                    if len(crop_kept["boxes"]) > 0:
+                        iou = box_iou(boxes, crop_kept["boxes"]).amax(1)
+                        keep_mask &= iou <= self.box_nms_thresh
+                    if len(prev_crops_kept["boxes"]) > 0:
+                        iou = box_iou(boxes, prev_crops_kept["boxes"]).amax(1)
+                        keep_mask &= iou <= self.crop_nms_thresh
+                    data.filter(keep_mask)
+                    crop_kept.cat(MaskData(boxes=boxes[keep_mask]))
+
+                    data.to_numpy()
+                    for record in self._mask_data_to_records(data):
+                        if predicate is not None and not predicate(record):
+                            continue
+                        yield record
+                        n_yielded += 1
+                        if max_masks is not None and n_yielded >= max_masks:
+                            return
+                prev_crops_kept.cat(crop_kept)
+        finally:
+            self._release_buffers()
+
+    def _mask_data_to_records(self, mask_data: MaskData) -> List[Dict[str, Any]]:
+        # Encode masks
+        n_masks = len(mask_data["iou_preds"])
+        if self.output_mode == "binary_mask":
+            mask_data["segmentations"] = [mask_data.get_mask(idx) for idx in range(n_masks)]
+        elif self.output_mode in ["uncompressed_rle", "coco_rle"]:
+            # Unpack a few masks at a time to bound memory
+            rles = []
+            for start in range(0, n_masks, 16):
+                packed = torch.as_tensor(mask_data["packed_masks"][start : start + 16])
+                rles.extend(mask_to_rle_pytorch(unpack_masks(packed, mask_data.mask_size)))
+            if self.output_mode == "coco_rle":
+                rles = [coco_encode_rle(rle) for rle in rles]
+            mask_data["segmentations"] = rles
 
         # Write mask records
         curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
+        for idx in range(len(mask_data["iou_preds"])):
             ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
                 "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
                 "stability_score": mask_data["stability_score"][idx].item(),
                 "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
+                "area": mask_data["areas"][idx].item(),
             }
+            if self.output_mode == "geometry":
+                mu20, mu11, mu02 = mask_data["central_moments"][idx].tolist()
+                ann["centroid"] = mask_data["centroids"][idx].tolist()
+                ann["central_moments"] = {"mu20": mu20, "mu11": mu11, "mu02": mu02}
+            else:
+                ann["segmentation"] = mask_data["segmentations"][idx]
             curr_anns.append(ann)
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(
+        self, image: np.ndarray, embedding: Optional[ImageEmbedding] = None
+    ) -> MaskData:
         orig_size = image.shape[:2]
-        crop_boxes, layer_idxs = generate_crop_boxes(
-            orig_size, self.crop_n_layers, self.crop_overlap_ratio
-        )
+        crop_boxes, layer_idxs = self._get_crop_boxes(orig_size)
 
-        # Iterate over image crops
-        data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        # Encode all crops in batches, then decode them one by one. The
+        # first crop is the whole image.
+        if embedding is not None:
+            self._check_embedding(embedding, orig_size)
+            embeddings = [embedding] + self._encode_crops(image, crop_boxes[1:])
+        else:
+            embeddings = self._encode_crops(image, crop_boxes)
+        data = MaskData.concat(
+            [
+                self._process_crop(image, crop_box, layer_idx, orig_size, embedding)
+                for crop_box, layer_idx, embedding in zip(crop_boxes, layer_idxs, embeddings)
+            ]
+        )
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -228,24 +447,12 @@ class SamAutomaticMaskGenerator:
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        embedding: Optional[ImageEmbedding] = None,
     ) -> MaskData:
-        # Crop the image and calculate embeddings
-        x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
-
-        # Get points for this crop
-        points_scale = np.array(cropped_im_size)[None, ::-1]
-        points_for_image = self.point_grids[crop_layer_idx] * points_scale
-
         # Generate masks for this crop in batches
-        data = MaskData()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
-            data.cat(batch_data)
-            del batch_data
-        self.predictor.reset_image()
+        data = MaskData.concat(
+            list(self._iter_crop_batches(image, crop_box, crop_layer_idx, orig_size, embedding))
+        )
 
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
@@ -257,31 +464,252 @@ class SamAutomaticMaskGenerator:
         data.filter(keep_by_nms)
 
         # Return to the original image frame
+        self._uncrop_data(data, crop_box)
+        return data
+
+    def _uncrop_data(self, data: MaskData, crop_box: List[int]) -> None:
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
+        if self.output_mode == "geometry":
+            # Central moments don't depend on the frame
+            data["centroids"] = uncrop_points(data["centroids"], crop_box)
+        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["iou_preds"]))])
 
-        return data
+    def _iter_crop_batches(
+        self,
+        image: np.ndarray,
+        crop_box: List[int],
+        crop_layer_idx: int,
+        orig_size: Tuple[int, ...],
+        embedding: Optional[ImageEmbedding] = None,
+    ) -> Iterator[MaskData]:
+        # Crop the image and calculate embeddings, unless already given
+        x0, y0, x1, y1 = crop_box
+        cropped_im = image[y0:y1, x0:x1, :]
+        cropped_im_size = cropped_im.shape[:2]
+        if embedding is None:
+            embedding = self.predictor.encode(cropped_im)
+
+        # Get points for this crop. Fixed grids are cached per crop size,
+        # foreground points depend on the pixels.
+        point_grid = self.point_grids[crop_layer_idx]
+        cache_key: Optional[Tuple[Any, ...]] = ("grid", crop_layer_idx)
+        if self.point_sampling == "foreground":
+            foreground_grid = build_foreground_point_grid(
+                estimate_foreground(cropped_im), self.points_budget
+            )
+            if len(foreground_grid) > 0:
+                point_grid = foreground_grid
+                cache_key = None
+
+        if self.point_sampling == "adaptive":
+            n_per_side = int(round(np.sqrt(len(point_grid))))
+            yield from self._iter_adaptive_batches(
+                embedding, n_per_side, cropped_im_size, crop_box, orig_size
+            )
+        else:
+            points_for_image, embeddings = self._get_point_prompts(
+                cache_key, point_grid, cropped_im_size
+            )
+            points_per_batch = self._get_points_per_batch(cropped_im_size, orig_size)
+            for points, sparse_embeddings in batch_iterator(
+                points_per_batch, points_for_image, embeddings
+            ):
+                yield self._process_batch(
+                    embedding, points, cropped_im_size, crop_box, orig_size, sparse_embeddings
+                )
+
+    def _encode_crops(
+        self, image: np.ndarray, crop_boxes: List[List[int]]
+    ) -> List[ImageEmbedding]:
+        """Runs the image encoder on the given crops, crops_per_batch at a time."""
+        crops = [image[y0:y1, x0:x1, :] for x0, y0, x1, y1 in crop_boxes]
+        return self.predictor.encode_batch(crops, batch_size=self.crops_per_batch)
+
+    @staticmethod
+    def _check_embedding(embedding: ImageEmbedding, orig_size: Tuple[int, ...]) -> None:
+        assert tuple(embedding.original_size) == tuple(
+            orig_size
+        ), f"Embedding of a {embedding.original_size} image given for a {orig_size} image."
+
+    def _get_points_per_batch(self, im_size: Tuple[int, ...], orig_size: Tuple[int, ...]) -> int:
+        """
+        Returns points_per_batch, or with a memory_budget and without
+        low_res_filtering, the number of points whose masks fit in it for a
+        crop of im_size. With low_res_filtering, a point only costs its
+        fixed size low res logits, and the budget bounds the masks upscaled
+        at once instead; see _get_masks_per_chunk.
+        """
+        if self.memory_budget is None or self.low_res_filtering:
+            return self.points_per_batch
+        # Three masks per point with multimask output
+        return max(1, self.memory_budget // (3 * self._get_bytes_per_mask(im_size, orig_size)))
+
+    def _get_masks_per_chunk(
+        self, im_size: Tuple[int, ...], orig_size: Tuple[int, ...]
+    ) -> Optional[int]:
+        """
+        With low_res_filtering and a memory_budget, returns the number of
+        masks that passed the filters to upscale and process at once for a
+        crop of im_size. Returns None, for all at once, without a budget.
+        """
+        if self.memory_budget is None:
+            return None
+        return max(1, self.memory_budget // self._get_bytes_per_mask(im_size, orig_size))
+
+    def _get_bytes_per_mask(self, im_size: Tuple[int, ...], orig_size: Tuple[int, ...]) -> int:
+        """
+        The memory one mask takes up once upscaled, for a crop of im_size.
+        The estimate is conservative: it adds up the peak size of every per
+        mask tensor even where they don't coexist.
+        """
+        crop_area = im_size[0] * im_size[1]
+        bytes_per_mask = crop_area * (4 + 1)  # Logits, binary mask
+        if self.low_res_filtering:
+            img_size = self.predictor.model.image_encoder.img_size
+            bytes_per_mask += img_size * img_size * 4  # Logits upscaled to the padded input size
+        else:
+            bytes_per_mask += crop_area * 2  # Stability masks
+        if self.output_mode != "geometry":
+            bytes_per_mask += orig_size[0] * orig_size[1] * 3  # Uncropped mask, and bit packing
+        return bytes_per_mask
+
+    def _get_buffer(self, name: str, shape: Tuple[int, ...], dtype: torch.dtype) -> torch.Tensor:
+        """
+        Returns a scratch tensor of the given shape, reusing the memory of
+        earlier calls with the same name from this thread. Its contents are
+        undefined and only valid until the next call with the same name.
+        """
+        numel = int(np.prod(shape))
+        device = self.predictor.device
+        buffer = getattr(self._buffers, name, None)
+        if (
+            buffer is None
+            or buffer.numel() < numel
+            or buffer.dtype != dtype
+            or buffer.device != device
+        ):
+            buffer = torch.empty(numel, dtype=dtype, device=device)
+            setattr(self._buffers, name, buffer)
+        return buffer[:numel].view(shape)
+
+    def _release_buffers(self) -> None:
+        """Frees this thread's scratch tensors, so they don't outlive a call."""
+        vars(self._buffers).clear()
+
+    def _get_crop_boxes(self, orig_size: Tuple[int, ...]) -> Tuple[List[List[int]], List[int]]:
+        orig_size = tuple(orig_size)
+        with self._cache_lock:
+            if orig_size in self._crop_boxes_cache:
+                self._crop_boxes_cache.move_to_end(orig_size)
+                return self._crop_boxes_cache[orig_size]
+            crop_boxes = generate_crop_boxes(orig_size, self.crop_n_layers, self.crop_overlap_ratio)
+            self._crop_boxes_cache[orig_size] = crop_boxes
+            if len(self._crop_boxes_cache) > self._POINT_PROMPTS_CACHE_SIZE:
+                self._crop_boxes_cache.popitem(last=False)
+            return crop_boxes
+
+    def _get_point_prompts(
+        self,
+        cache_key: Optional[Tuple[Any, ...]],
+        point_grid: np.ndarray,
+        im_size: Tuple[int, ...],
+    ) -> Tuple[np.ndarray, torch.Tensor]:
+        """
+        Returns a normalized point grid in the frame of an image of im_size,
+        and the sparse prompt embeddings of its points as single positive
+        clicks. These only depend on the grid and the image size, so unless
+        cache_key is None they are cached, with the image size and device
+        added to the key.
+        """
+        key = None
+        if cache_key is not None:
+            key = (*cache_key, tuple(im_size), str(self.predictor.device))
+            with self._cache_lock:
+                if key in self._point_prompts_cache:
+                    self._point_prompts_cache.move_to_end(key)
+                    return self._point_prompts_cache[key]
+
+        points = point_grid * np.array(im_size)[None, ::-1]
+        transformed_points = self.predictor.transform.apply_coords(points, im_size)
+        in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
+        in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
+        embeddings, _ = self.predictor.model.prompt_encoder(
+            points=(in_points[:, None, :], in_labels[:, None]), boxes=None, masks=None
+        )
+
+        if key is not None:
+            with self._cache_lock:
+                self._point_prompts_cache[key] = (points, embeddings)
+                if len(self._point_prompts_cache) > self._POINT_PROMPTS_CACHE_SIZE:
+                    self._point_prompts_cache.popitem(last=False)
+        return points, embeddings
+
+    def _iter_adaptive_batches(
+        self,
+        embedding: ImageEmbedding,
+        n_per_side: int,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+    ) -> Iterator[MaskData]:
+        # Union of the masks accepted so far, in the crop's frame
+        coverage = torch.zeros(im_size, dtype=torch.bool, device=self.predictor.device)
+        points_budget = self.adaptive_points_budget
+        if points_budget is None:
+            points_budget = n_per_side**2
+        n_decoded = 0
+
+        # Coarse to fine
+        for level_n_per_side in sorted({max(1, n_per_side // 4), max(1, n_per_side // 2), n_per_side}):
+            points, embeddings = self._get_point_prompts(
+                ("level", level_n_per_side), build_point_grid(level_n_per_side), im_size
+            )
+            pixels = torch.as_tensor(points.astype(int), device=coverage.device)
+            keep = (~coverage[pixels[:, 1], pixels[:, 0]]).nonzero()[:, 0]
+            keep = keep[: points_budget - n_decoded]
+            points, embeddings = points[keep.cpu().numpy()], embeddings[keep]
+            for batch_points, batch_embeddings in batch_iterator(
+                self._get_points_per_batch(im_size, orig_size), points, embeddings
+            ):
+                yield self._process_batch(
+                    embedding,
+                    batch_points,
+                    im_size,
+                    crop_box,
+                    orig_size,
+                    batch_embeddings,
+                    coverage,
+                )
+            n_decoded += len(points)
+            if n_decoded >= points_budget or bool(coverage.all()):
+                break
 
     def _process_batch(
         self,
+        embedding: ImageEmbedding,
         points: np.ndarray,
         im_size: Tuple[int, ...],
         crop_box: List[int],
         orig_size: Tuple[int, ...],
+        sparse_embeddings: torch.Tensor,
+        coverage: Optional[torch.Tensor] = None,
     ) -> MaskData:
-        orig_h, orig_w = orig_size
-
         # Run model on this batch
-        transformed_points = self.predictor.transform.apply_coords(points, im_size)
-        in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
-        in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=in_points.device)
-        masks, iou_preds, _ = self.predictor.predict_torch(
-            in_points[:, None, :],
-            in_labels[:, None],
+        masks, iou_preds, low_res_masks = self.predictor.predict_torch_with_embedding(
+            embedding,
+            None,
+            None,
+            sparse_prompt_embeddings=sparse_embeddings,
             multimask_output=True,
             return_logits=True,
+            upscale_masks=not self.low_res_filtering,
         )
+        if self.low_res_filtering:
+            masks = low_res_masks
+            scale = low_res_masks.shape[-1] / self.predictor.model.image_encoder.img_size
+            low_res_h = int(np.ceil(embedding.input_size[0] * scale))
+            low_res_w = int(np.ceil(embedding.input_size[1] * scale))
 
         # Serialize predictions and store in MaskData
         data = MaskData(
@@ -289,7 +717,7 @@ class SamAutomaticMaskGenerator:
             iou_preds=iou_preds.flatten(0, 1),
             points=torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
         )
-        del masks
+        del masks, low_res_masks
 
         # Filter by predicted IoU
         if self.pred_iou_thresh > 0.0:
@@ -297,15 +725,54 @@ class SamAutomaticMaskGenerator:
             data.filter(keep_mask)
 
         # Calculate stability score
+        stability_masks = data["masks"]
+        if self.low_res_filtering:
+            # Leave out the padding, which is always background
+            stability_masks = stability_masks[..., : low_res_h, : low_res_w]
         data["stability_score"] = calculate_stability_score(
-            data["masks"], self.predictor.model.mask_threshold, self.stability_score_offset
+            stability_masks, self.predictor.model.mask_threshold, self.stability_score_offset
         )
+        del stability_masks
         if self.stability_score_thresh > 0.0:
             keep_mask = data["stability_score"] >= self.stability_score_thresh
             data.filter(keep_mask)
 
+        if not self.low_res_filtering:
+            return self._process_masks(data, im_size, crop_box, orig_size, coverage)
+
+        # Upscale the surviving low res logits to the image size, a chunk at
+        # a time, so only a chunk's full size masks are in memory at once
+        n_masks = len(data["iou_preds"])
+        chunk_size = self._get_masks_per_chunk(im_size, orig_size) or max(n_masks, 1)
+        chunks = []
+        for start in range(0, max(n_masks, 1), chunk_size):
+            chunk = MaskData(**{k: v[start : start + chunk_size] for k, v in data.items()})
+            chunk["masks"] = self.predictor.model.postprocess_masks(
+                chunk["masks"][:, None], embedding.input_size, embedding.original_size
+            )[:, 0]
+            chunks.append(self._process_masks(chunk, im_size, crop_box, orig_size, coverage))
+        return MaskData.concat(chunks)
+
+    def _process_masks(
+        self,
+        data: MaskData,
+        im_size: Tuple[int, ...],
+        crop_box: List[int],
+        orig_size: Tuple[int, ...],
+        coverage: Optional[torch.Tensor] = None,
+    ) -> MaskData:
+        """
+        The rest of _process_batch, on masks that have passed the filters
+        and been upscaled to the crop's size.
+        """
+        orig_h, orig_w = orig_size
+
         # Threshold masks and calculate boxes
-        data["masks"] = data["masks"] > self.predictor.model.mask_threshold
+        data["masks"] = torch.gt(
+            data["masks"],
+            self.predictor.model.mask_threshold,
+            out=self._get_buffer("masks", data["masks"].shape, torch.bool),
+        )
         data["boxes"] = batched_mask_to_box(data["masks"])
 
         # Filter boxes that touch crop boundaries
@@ -313,60 +780,123 @@ class SamAutomaticMaskGenerator:
         if not torch.all(keep_mask):
             data.filter(keep_mask)
 
-        # Compress to RLE
-        data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
+        # Mark the accepted masks, in place, for adaptive point sampling
+        if coverage is not None and len(data["masks"]) > 0:
+            coverage |= data["masks"].any(0)
+
+        if self.output_mode == "geometry":
+            data["areas"], data["centroids"], data["central_moments"] = batched_mask_moments(
+                data["masks"]
+            )
+            if self.min_mask_region_area > 0:
+                # Only keep what lies within each mask's box, which is all
+                # postprocess_small_regions needs
+                masks = data["masks"].cpu().numpy()
+                data["box_masks"] = [
+                    np.packbits(mask[y0 : y1 + 1, x0 : x1 + 1])
+                    for mask, (x0, y0, x1, y1) in zip(masks, data["boxes"].tolist())
+                ]
+                data.mask_size = (orig_h, orig_w)
+            del data["masks"]
+            return data
+        else:
+            data["areas"] = data["masks"].sum((1, 2))
+
+        # Bit-pack in the original image frame
+        uncropped = self._get_buffer(
+            "uncropped_masks", (len(data["masks"]), orig_h, orig_w), torch.bool
+        )
+        data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w, out=uncropped)
+        data["packed_masks"] = pack_masks(data["masks"])
+        data.mask_size = (orig_h, orig_w)
         del data["masks"]
 
         return data
 
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData,
+        min_area: int,
+        nms_thresh: float,
+        num_workers: Optional[int] = None,
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
-        box NMS to remove any new duplicates.
+        box NMS to remove any new duplicates. Each mask is only searched
+        within its padded bounding box where that gives the same result,
+        and masks are processed on a pool of num_workers threads (one per
+        CPU if None).
 
         Edits mask_data in place.
 
         Requires open-cv as a dependency.
         """
-        if len(mask_data["rles"]) == 0:
+        n_masks = len(mask_data["iou_preds"])
+        if n_masks == 0:
             return mask_data
 
-        # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
-
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
-            # Give score=0 to changed masks and score=1 to unchanged masks
-            # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
-
-        # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        # Pixel indices, even if boxes were concatenated with floats
+        boxes = torch.as_tensor(mask_data["boxes"]).cpu().to(torch.long, copy=True)
+        if "box_masks" in mask_data:
+            # Geometry output only kept each mask within its box, and outside
+            # of it the mask is empty
+            def clean(idx: int) -> Optional[Tuple[np.ndarray, List[int]]]:
+                box = boxes[idx].tolist()
+                shape = (box[3] - box[1] + 1, box[2] - box[0] + 1)
+                box_mask = np.unpackbits(mask_data["box_masks"][idx], count=shape[0] * shape[1])
+                return remove_small_regions_in_box(
+                    box_mask.reshape(shape).view(bool), box, mask_data.mask_size, min_area
+                )
+
+        else:
+            # Masks are cleaned up in place, on the CPU
+            packed = mask_data["packed_masks"]
+            packed_np = packed.cpu().numpy() if isinstance(packed, torch.Tensor) else packed
+
+            def clean(idx: int) -> Optional[Tuple[np.ndarray, List[int]]]:
+                return remove_small_regions_packed(
+                    packed_np[idx], mask_data.mask_size, boxes[idx].tolist(), min_area
+                )
+
+        # OpenCV releases the GIL, so masks are cleaned up in parallel
+        num_workers = min(n_masks, num_workers or os.cpu_count() or 1)
+        with ThreadPoolExecutor(num_workers) as pool:
+            cleaned = list(pool.map(clean, range(n_masks)))
+        if "box_masks" in mask_data:
+            del mask_data["box_masks"]
+        elif isinstance(packed, torch.Tensor) and packed.device.type != "cpu":
+            mask_data["packed_masks"] = torch.as_tensor(packed_np, device=packed.device)
+
+        # Give score=0 to changed masks and score=1 to unchanged masks
+        # so NMS will prefer ones that didn't need postprocessing
+        scores = torch.as_tensor([float(result is None) for result in cleaned])
+        for idx, result in enumerate(cleaned):
+            if result is not None:
+                crop, (x0, y0, _, _) = result
+                offset = torch.as_tensor([x0, y0, x0, y0])
+                boxes[idx] = batched_mask_to_box(torch.as_tensor(crop)[None])[0] + offset
+
+        # Remove any new duplicates
         keep_by_nms = batched_nms(
             boxes.float(),
-            torch.as_tensor(scores),
+            scores,
             torch.zeros_like(boxes[:, 0]),  # categories
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
+        # Only update the masks that have changed
         for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
+            result = cleaned[i_mask]
+            if result is not None:
+                crop, (x0, y0, _, _) = result
                 mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
+                mask_data["areas"][i_mask] = int(crop.sum())
+                if "central_moments" in mask_data:
+                    # Central moments don't depend on the frame
+                    crop_torch = torch.as_tensor(crop)[None]
+                    _, centroid, central_moments = batched_mask_moments(crop_torch)
+                    mask_data["centroids"][i_mask] = centroid[0] + torch.as_tensor([x0, y0])
+                    mask_data["central_moments"][i_mask] = central_moments[0]
         mask_data.filter(keep_by_nms)
 
         return mask_data
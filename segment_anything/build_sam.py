@@ -5,7 +5,9 @@
 # LICENSE file in the root directory of this source tree.
 
 import torch
+from torch import nn
 
+from contextlib import nullcontext
 from functools import partial
 
 from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer
@@ -44,14 +46,65 @@ def build_sam_vit_b(checkpoint=None):
     )
 
 
+def build_sam_vit_b_int8(checkpoint=None):
+    """
+    Builds vit_b with dynamic int8 quantization applied to the Linear layers
+    of the image encoder. The checkpoint can be either the original fp32
+    checkpoint, which is quantized after loading, or a quantized state dict
+    written by save_quantized_sam.
+    """
+    state_dict = None if checkpoint is None else _load_checkpoint(checkpoint)
+    if state_dict is None or not _is_quantized_state_dict(state_dict):
+        return quantize_image_encoder(build_sam_vit_b(checkpoint=state_dict))
+
+    # Packed int8 weights can't be assigned onto a meta skeleton, so build
+    # and quantize a regular model first.
+    sam = quantize_image_encoder(build_sam_vit_b())
+    sam.load_state_dict(state_dict)
+    return sam
+
+
 sam_model_registry = {
     "default": build_sam_vit_h,
     "vit_h": build_sam_vit_h,
     "vit_l": build_sam_vit_l,
     "vit_b": build_sam_vit_b,
+    "vit_b_int8": build_sam_vit_b_int8,
 }
 
 
+def quantize_image_encoder(sam):
+    """
+    Applies dynamic int8 quantization in place to the Linear layers of the
+    image encoder, i.e. the qkv/proj layers of each Attention and the two
+    layers of each MLPBlock. The neck, prompt encoder and mask decoder stay
+    in fp32.
+    """
+    torch.ao.quantization.quantize_dynamic(
+        sam.image_encoder, {nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+    return sam
+
+
+def save_quantized_sam(sam, path):
+    """Saves the state of a quantized model, for loading with build_sam_vit_b_int8."""
+    with open(path, "wb") as f:
+        torch.save(sam.state_dict(), f)
+
+
+def _load_checkpoint(checkpoint):
+    # Checkpoints may also be passed as an already loaded state dict
+    if isinstance(checkpoint, dict):
+        return checkpoint
+    # mmap maps the tensor storages from the file instead of copying them
+    # into memory; pages are shared with other processes loading the same file.
+    return torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
+
+
+def _is_quantized_state_dict(state_dict):
+    return any(k.endswith("_packed_params._packed_params") for k in state_dict)
+
+
 def _build_sam(
     encoder_embed_dim,
     encoder_depth,
@@ -63,8 +116,12 @@ def _build_sam(
     image_size = 1024
     vit_patch_size = 16
     image_embedding_size = image_size // vit_patch_size
-    sam = Sam(
-        image_encoder=ImageEncoderViT(
+    # With a checkpoint, build the image encoder (nearly all of the weights)
+    # on the meta device: no memory is allocated or initialized for weights
+    # the checkpoint overwrites anyway. The prompt encoder and mask decoder
+    # are small and use normal_ init, whose first meta call costs seconds.
+    with torch.device("meta") if checkpoint is not None else nullcontext():
+        image_encoder = ImageEncoderViT(
             depth=encoder_depth,
             embed_dim=encoder_embed_dim,
             img_size=image_size,
@@ -77,31 +134,33 @@ def _build_sam(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
+        )
+    prompt_encoder = PromptEncoder(
+        embed_dim=prompt_embed_dim,
+        image_embedding_size=(image_embedding_size, image_embedding_size),
+        input_image_size=(image_size, image_size),
+        mask_in_chans=16,
+    )
+    mask_decoder = MaskDecoder(
+        num_multimask_outputs=3,
+        transformer=TwoWayTransformer(
+            depth=2,
+            embedding_dim=prompt_embed_dim,
+            mlp_dim=2048,
+            num_heads=8,
         ),
-        prompt_encoder=PromptEncoder(
-            embed_dim=prompt_embed_dim,
-            image_embedding_size=(image_embedding_size, image_embedding_size),
-            input_image_size=(image_size, image_size),
-            mask_in_chans=16,
-        ),
-        mask_decoder=MaskDecoder(
-            num_multimask_outputs=3,
-            transformer=TwoWayTransformer(
-                depth=2,
-                embedding_dim=prompt_embed_dim,
-                mlp_dim=2048,
-                num_heads=8,
-            ),
-            transformer_dim=prompt_embed_dim,
-            iou_head_depth=3,
-            iou_head_hidden_dim=256,
-        ),
+        transformer_dim=prompt_embed_dim,
+        iou_head_depth=3,
+        iou_head_hidden_dim=256,
+    )
+    sam = Sam(
+        image_encoder=image_encoder,
+        prompt_encoder=prompt_encoder,
+        mask_decoder=mask_decoder,
         pixel_mean=[123.675, 116.28, 103.53],
         pixel_std=[58.395, 57.12, 57.375],
     )
     sam.eval()
     if checkpoint is not None:
-        with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
-        sam.load_state_dict(state_dict)
+        sam.load_state_dict(_load_checkpoint(checkpoint), assign=True)
     return sam
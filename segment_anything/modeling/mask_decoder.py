@@ -122,11 +122,12 @@ class MaskDecoder(nn.Module):
         output_tokens = output_tokens.unsqueeze(0).expand(sparse_prompt_embeddings.size(0), -1, -1)
         tokens = torch.cat((output_tokens, sparse_prompt_embeddings), dim=1)
 
-        # Expand per-image data in batch direction to be per-mask
-        src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
-        src = src + dense_prompt_embeddings
-        pos_src = torch.repeat_interleave(image_pe, tokens.shape[0], dim=0)
-        b, c, h, w = src.shape
+        # The image embedding and its positional encoding are shared by all
+        # prompts of an image. Keep them at batch size 1 and let the
+        # transformer broadcast them, instead of copying them per prompt.
+        src = image_embeddings + dense_prompt_embeddings
+        pos_src = image_pe
+        _, c, h, w = src.shape
 
         # Run the transformer
         hs, src = self.transformer(src, pos_src, tokens)
@@ -134,20 +135,34 @@ class MaskDecoder(nn.Module):
         mask_tokens_out = hs[:, 1 : (1 + self.num_mask_tokens), :]
 
         # Upscale mask embeddings and predict masks using the mask tokens
-        src = src.transpose(1, 2).view(b, c, h, w)
+        src = src.transpose(1, 2).reshape(-1, c, h, w)
         upscaled_embedding = self.output_upscaling(src)
-        hyper_in_list: List[torch.Tensor] = []
-        for i in range(self.num_mask_tokens):
-            hyper_in_list.append(self.output_hypernetworks_mlps[i](mask_tokens_out[:, i, :]))
-        hyper_in = torch.stack(hyper_in_list, dim=1)
+        hyper_in = self._predict_hypernetwork_weights(mask_tokens_out)
         b, c, h, w = upscaled_embedding.shape
-        masks = (hyper_in @ upscaled_embedding.view(b, c, h * w)).view(b, -1, h, w)
+        masks = (hyper_in @ upscaled_embedding.view(b, c, h * w)).view(hyper_in.shape[0], -1, h, w)
 
         # Generate mask quality predictions
         iou_pred = self.iou_prediction_head(iou_token_out)
 
         return masks, iou_pred
 
+    def _predict_hypernetwork_weights(self, mask_tokens_out: torch.Tensor) -> torch.Tensor:
+        """
+        Runs output_hypernetworks_mlps[i] on mask token i, for all tokens at
+        once: the weights of the per-token MLPs are stacked so each layer is
+        a single batched matmul. BxTxC -> BxTx(C/8).
+        """
+        x = mask_tokens_out.transpose(0, 1)  # T x B x C
+        num_layers = self.output_hypernetworks_mlps[0].num_layers
+        for i in range(num_layers):
+            layers = [mlp.layers[i] for mlp in self.output_hypernetworks_mlps]
+            weight = torch.stack([layer.weight for layer in layers])  # T x C_out x C_in
+            bias = torch.stack([layer.bias for layer in layers])  # T x C_out
+            x = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+            if i < num_layers - 1:
+                x = F.relu(x)
+        return x.transpose(0, 1)
+
 
 # Lightly adapted from
 # https://github.com/facebookresearch/MaskFormer/blob/main/mask_former/modeling/transformer/transformer_predictor.py # noqa
@@ -59,6 +59,8 @@ class PromptEncoder(nn.Module):
         )
         self.no_mask_embed = nn.Embedding(1, embed_dim)
 
+        self._dense_pe_cache: Optional[Tuple[Tuple[Any, ...], torch.Tensor]] = None
+
     def get_dense_pe(self) -> torch.Tensor:
         """
         Returns the positional encoding used to encode point prompts,
@@ -68,7 +70,13 @@ class PromptEncoder(nn.Module):
           torch.Tensor: Positional encoding with shape
             1x(embed_dim)x(embedding_h)x(embedding_w)
         """
-        return self.pe_layer(self.image_embedding_size).unsqueeze(0)
+        # Only depends on the (fixed) frequency matrix, so compute it once
+        # per device and version of that buffer.
+        gaussian_matrix = self.pe_layer.positional_encoding_gaussian_matrix
+        key = (gaussian_matrix.device, gaussian_matrix.data_ptr(), gaussian_matrix._version)
+        if self._dense_pe_cache is None or self._dense_pe_cache[0] != key:
+            self._dense_pe_cache = (key, self.pe_layer(self.image_embedding_size).unsqueeze(0))
+        return self._dense_pe_cache[1]
 
     def _embed_points(
         self,
@@ -8,7 +8,9 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import Any, Dict, List, Tuple
+import math
+
+from typing import Any, Dict, List, Optional, Tuple
 
 from .image_encoder import ImageEncoderViT
 from .mask_decoder import MaskDecoder
@@ -161,8 +163,106 @@ class Sam(nn.Module):
         masks = F.interpolate(masks, original_size, mode="bilinear", align_corners=False)
         return masks
 
-    def preprocess(self, x: torch.Tensor) -> torch.Tensor:
-        """Normalize pixel values and pad to a square input."""
+    def postprocess_masks_fused(
+        self,
+        masks: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+        crop_to_box: bool = False,
+    ) -> torch.Tensor:
+        """
+        A cheaper postprocess_masks: a single bilinear resize from the
+        unpadded part of the low resolution masks straight to the original
+        image size, without the intermediate image_encoder.img_size masks.
+        Values differ slightly from postprocess_masks, since two bilinear
+        resizes are not the same as one.
+
+        Arguments:
+          masks (torch.Tensor): Batched masks from the mask_decoder,
+            in BxCxHxW format.
+          input_size (tuple(int, int)): The size of the image input to the
+            model, in (H, W) format. Used to remove padding.
+          original_size (tuple(int, int)): The original size of the image
+            before resizing for input to the model, in (H, W) format.
+          crop_to_box (bool): If true, only resizes each mask within the
+            bounding box of its low resolution pixels above mask_threshold,
+            plus a one pixel margin. The thresholded masks are the same; the
+            logits outside the box are set to the mask's minimum logit.
+
+        Returns:
+          (torch.Tensor): Batched masks in BxCxHxW format, where (H, W)
+            is given by original_size.
+        """
+        # Size of the unpadded region, in (fractional) low res pixels
+        low_res_scale = masks.shape[-1] / self.image_encoder.img_size
+        valid_h = input_size[0] * low_res_scale
+        valid_w = input_size[1] * low_res_scale
+        scale_factor = (original_size[0] / valid_h, original_size[1] / valid_w)
+        masks = masks[..., : math.ceil(valid_h), : math.ceil(valid_w)]
+
+        if not crop_to_box:
+            # With an explicit scale_factor, output pixel i samples the input
+            # at (i + 0.5) / scale - 0.5, so the valid region maps exactly
+            # onto original_size. The output size is floored, and may fall a
+            # pixel short through rounding, so one more row and column are
+            # added first; repeating the edge keeps the clamped edge values.
+            masks = F.interpolate(
+                F.pad(masks, (0, 1, 0, 1), mode="replicate"),
+                scale_factor=scale_factor,
+                mode="bilinear",
+                align_corners=False,
+                recompute_scale_factor=False,
+            )
+            return masks[..., : original_size[0], : original_size[1]]
+
+        b, c, low_h, low_w = masks.shape
+        flat_masks = masks.reshape(b * c, 1, low_h, low_w)
+        out = flat_masks.amin(dim=(-2, -1), keepdim=True).expand(-1, -1, *original_size).clone()
+        for i, mask in enumerate(flat_masks):
+            on = (mask[0] > self.mask_threshold).nonzero()
+            if len(on) == 0:
+                continue
+            # Output pixels whose bilinear neighbours include a low res
+            # pixel of the box (grown by one)
+            (y0, x0), (y1, x1) = (on.amin(0) - 1).tolist(), (on.amax(0) + 1).tolist()
+            oy0 = max(0, int((y0 + 0.5) * scale_factor[0] - 0.5))
+            ox0 = max(0, int((x0 + 0.5) * scale_factor[1] - 0.5))
+            oy1 = min(original_size[0], math.ceil((y1 + 1.5) * scale_factor[0] - 0.5))
+            ox1 = min(original_size[1], math.ceil((x1 + 1.5) * scale_factor[1] - 0.5))
+            if oy1 <= oy0 or ox1 <= ox0:
+                continue
+
+            # Sample the same positions as the full resize, as grid_sample
+            # coordinates normalized to [-1, 1]
+            ys = (torch.arange(oy0, oy1, device=masks.device) + 0.5) / scale_factor[0]
+            xs = (torch.arange(ox0, ox1, device=masks.device) + 0.5) / scale_factor[1]
+            grid = torch.stack(
+                torch.meshgrid(2 * xs / low_w - 1, 2 * ys / low_h - 1, indexing="xy"), dim=-1
+            )
+            out[i, :, oy0:oy1, ox0:ox1] = F.grid_sample(
+                mask[None],
+                grid[None].to(masks.dtype),
+                mode="bilinear",
+                padding_mode="border",
+                align_corners=False,
+            )[0]
+        return out.reshape(b, c, *original_size)
+
+    def preprocess(self, x: torch.Tensor, out: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Normalize pixel values and pad to a square input. If given, the result
+        is written into 'out', a float tensor of shape Bx3xSxS with S the
+        encoder's img_size, in a single pass over the image.
+        """
+        if out is not None:
+            h, w = x.shape[-2:]
+            # (x - mean) / std as one multiply-add, and zero only the padding
+            scale = 1.0 / self.pixel_std
+            torch.addcmul(-self.pixel_mean * scale, x, scale, out=out[..., :h, :w])
+            out[..., h:, :].zero_()
+            out[..., :h, w:].zero_()
+            return out
+
         # Normalize colors
         x = (x - self.pixel_mean) / self.pixel_std
 
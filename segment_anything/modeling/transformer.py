@@ -6,6 +6,7 @@
 
 import torch
 from torch import Tensor, nn
+from torch.nn import functional as F
 
 import math
 from typing import Tuple, Type
@@ -22,6 +23,7 @@ class TwoWayTransformer(nn.Module):
         mlp_dim: int,
         activation: Type[nn.Module] = nn.ReLU,
         attention_downsample_rate: int = 2,
+        use_sdpa: bool = True,
     ) -> None:
         """
         A transformer decoder that attends to an input image using
@@ -34,6 +36,8 @@ class TwoWayTransformer(nn.Module):
             divide embedding_dim
           mlp_dim (int): the channel dimension internal to the MLP block
           activation (nn.Module): the activation to use in the MLP block
+          use_sdpa (bool): compute attention with the fused
+            scaled_dot_product_attention kernel instead of the reference path
         """
         super().__init__()
         self.depth = depth
@@ -51,11 +55,12 @@ class TwoWayTransformer(nn.Module):
                     activation=activation,
                     attention_downsample_rate=attention_downsample_rate,
                     skip_first_layer_pe=(i == 0),
+                    use_sdpa=use_sdpa,
                 )
             )
 
         self.final_attn_token_to_image = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate
+            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, use_sdpa=use_sdpa
         )
         self.norm_final_attn = nn.LayerNorm(embedding_dim)
 
@@ -68,9 +73,10 @@ class TwoWayTransformer(nn.Module):
         """
         Args:
           image_embedding (torch.Tensor): image to attend to. Should be shape
-            B x embedding_dim x h x w for any h and w.
+            B x embedding_dim x h x w for any h and w. B may be 1 when it is
+            shared by all queries, and is then broadcast.
           image_pe (torch.Tensor): the positional encoding to add to the image. Must
-            have the same shape as image_embedding.
+            have the same shape as image_embedding, or batch size 1.
           point_embedding (torch.Tensor): the embedding to add to the query points.
             Must have shape B x N_points x embedding_dim for any N_points.
 
@@ -115,6 +121,7 @@ class TwoWayAttentionBlock(nn.Module):
         activation: Type[nn.Module] = nn.ReLU,
         attention_downsample_rate: int = 2,
         skip_first_layer_pe: bool = False,
+        use_sdpa: bool = True,
     ) -> None:
         """
         A transformer block with four layers: (1) self-attention of sparse
@@ -128,13 +135,14 @@ class TwoWayAttentionBlock(nn.Module):
           mlp_dim (int): the hidden dimension of the mlp block
           activation (nn.Module): the activation of the mlp block
           skip_first_layer_pe (bool): skip the PE on the first layer
+          use_sdpa (bool): use the fused scaled_dot_product_attention kernel
         """
         super().__init__()
-        self.self_attn = Attention(embedding_dim, num_heads)
+        self.self_attn = Attention(embedding_dim, num_heads, use_sdpa=use_sdpa)
         self.norm1 = nn.LayerNorm(embedding_dim)
 
         self.cross_attn_token_to_image = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate
+            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, use_sdpa=use_sdpa
         )
         self.norm2 = nn.LayerNorm(embedding_dim)
 
@@ -143,7 +151,7 @@ class TwoWayAttentionBlock(nn.Module):
 
         self.norm4 = nn.LayerNorm(embedding_dim)
         self.cross_attn_image_to_token = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate
+            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, use_sdpa=use_sdpa
         )
 
         self.skip_first_layer_pe = skip_first_layer_pe
@@ -193,12 +201,14 @@ class Attention(nn.Module):
         embedding_dim: int,
         num_heads: int,
         downsample_rate: int = 1,
+        use_sdpa: bool = True,
     ) -> None:
         super().__init__()
         self.embedding_dim = embedding_dim
         self.internal_dim = embedding_dim // downsample_rate
         self.num_heads = num_heads
         assert self.internal_dim % num_heads == 0, "num_heads must divide embedding_dim."
+        self.use_sdpa = use_sdpa
 
         self.q_proj = nn.Linear(embedding_dim, self.internal_dim)
         self.k_proj = nn.Linear(embedding_dim, self.internal_dim)
@@ -227,13 +237,23 @@ class Attention(nn.Module):
         v = self._separate_heads(v, self.num_heads)
 
         # Attention
-        _, _, _, c_per_head = q.shape
-        attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
-        attn = attn / math.sqrt(c_per_head)
-        attn = torch.softmax(attn, dim=-1)
+        if self.use_sdpa:
+            # The image side may be shared by all prompts (batch size 1).
+            # Expanding is a view, and keeps results identical to a copy.
+            # Export traces a single prompt, so there is nothing to expand.
+            if not torch.jit.is_tracing():
+                b = max(q.shape[0], k.shape[0])
+                q, k, v = (x.expand(b, -1, -1, -1) for x in (q, k, v))
+            # The default scale of scaled_dot_product_attention is 1 / sqrt(c_per_head)
+            out = F.scaled_dot_product_attention(q, k, v)
+        else:
+            _, _, _, c_per_head = q.shape
+            attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
+            attn = attn / math.sqrt(c_per_head)
+            attn = torch.softmax(attn, dim=-1)
+            out = attn @ v
 
         # Get output
-        out = attn @ v
         out = self._recombine_heads(out)
         out = self.out_proj(out)
 
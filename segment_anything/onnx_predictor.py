@@ -0,0 +1,202 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Deliberately does not import torch, so serving processes can run SAM on
+# onnxruntime alone. See segment_anything.utils.onnx for the exporters.
+
+import numpy as np
+from PIL import Image
+
+from typing import Optional, Sequence, Tuple
+
+_GRAPH_OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+class OnnxSamPredictor:
+    def __init__(
+        self,
+        encoder_path: str,
+        decoder_path: str,
+        img_size: int = 1024,
+        mask_threshold: float = 0.0,
+        intra_op_num_threads: Optional[int] = None,
+        inter_op_num_threads: Optional[int] = None,
+        graph_optimization_level: str = "all",
+        providers: Sequence[str] = ("CPUExecutionProvider",),
+    ) -> None:
+        """
+        A SamPredictor equivalent that runs the image encoder and mask decoder
+        exported by 'export_image_encoder' and 'export_mask_decoder' (with
+        return_single_mask=False) on onnxruntime sessions, without torch.
+
+        Arguments:
+          encoder_path (str): Path to the exported image encoder.
+          decoder_path (str): Path to the exported prompt encoder and mask decoder.
+          img_size (int): The encoder's input size; 1024 for all SAM models.
+          mask_threshold (float): The logit threshold used to binarize masks.
+          intra_op_num_threads (int or None): Threads used within an operator.
+            If None, onnxruntime picks the number of physical cores.
+          inter_op_num_threads (int or None): Threads used across operators.
+          graph_optimization_level (str): The onnxruntime graph optimization
+            level, in ['disable', 'basic', 'extended', 'all'].
+          providers (list(str)): The onnxruntime execution providers.
+        """
+        import onnxruntime as ort  # type: ignore
+
+        assert (
+            graph_optimization_level in _GRAPH_OPTIMIZATION_LEVELS
+        ), f"Unknown graph_optimization_level {graph_optimization_level}."
+        options = ort.SessionOptions()
+        options.graph_optimization_level = getattr(
+            ort.GraphOptimizationLevel, _GRAPH_OPTIMIZATION_LEVELS[graph_optimization_level]
+        )
+        if intra_op_num_threads is not None:
+            options.intra_op_num_threads = intra_op_num_threads
+        if inter_op_num_threads is not None:
+            options.inter_op_num_threads = inter_op_num_threads
+
+        self.encoder = ort.InferenceSession(
+            encoder_path, sess_options=options, providers=list(providers)
+        )
+        self.decoder = ort.InferenceSession(
+            decoder_path, sess_options=options, providers=list(providers)
+        )
+        self.img_size = img_size
+        self.mask_threshold = mask_threshold
+        self.image_format = "RGB"
+        self.reset_image()
+
+    def set_image(
+        self,
+        image: np.ndarray,
+        image_format: str = "RGB",
+    ) -> None:
+        """
+        Calculates the image embeddings for the provided image, allowing
+        masks to be predicted with the 'predict' method.
+
+        Arguments:
+          image (np.ndarray): The image for calculating masks. Expects an
+            image in HWC uint8 format, with pixel values in [0, 255].
+          image_format (str): The color format of the image, in ['RGB', 'BGR'].
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        if image_format != self.image_format:
+            image = image[..., ::-1]
+
+        # The PIL resize ResizeLongestSide.apply_image matches to within 1
+        input_size = self.get_preprocess_shape(image.shape[0], image.shape[1], self.img_size)
+        input_image = Image.fromarray(np.ascontiguousarray(image)).resize(
+            input_size[::-1], Image.BILINEAR
+        )
+        input_image = np.asarray(input_image, dtype=np.float32)
+
+        self.reset_image()
+        (self.features,) = self.encoder.run(None, {"input_image": input_image})
+        self.original_size = image.shape[:2]
+        self.input_size = input_size
+        self.is_image_set = True
+
+    def predict(
+        self,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        box: Optional[np.ndarray] = None,
+        mask_input: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Predict masks for the given input prompts, using the currently set image.
+        Arguments and return values are the same as for SamPredictor.predict.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        # Points and box corners go through the same sparse input, with
+        # labels 2 and 3 marking box corners and -1 a padding point.
+        coords = np.zeros((0, 2), dtype=np.float32)
+        labels = np.zeros((0,), dtype=np.float32)
+        if point_coords is not None:
+            assert (
+                point_labels is not None
+            ), "point_labels must be supplied if point_coords is supplied."
+            coords = np.concatenate([coords, np.asarray(point_coords, dtype=np.float32)])
+            labels = np.concatenate([labels, np.asarray(point_labels, dtype=np.float32)])
+        if box is not None:
+            coords = np.concatenate([coords, np.asarray(box, dtype=np.float32).reshape(2, 2)])
+            labels = np.concatenate([labels, np.array([2, 3], dtype=np.float32)])
+        else:
+            coords = np.concatenate([coords, np.zeros((1, 2), dtype=np.float32)])
+            labels = np.concatenate([labels, np.array([-1], dtype=np.float32)])
+        coords = self.apply_coords(coords, self.original_size)
+
+        if mask_input is None:
+            mask_input = np.zeros((1, 1, self.img_size // 4, self.img_size // 4), dtype=np.float32)
+            has_mask_input = np.zeros(1, dtype=np.float32)
+        else:
+            mask_input = np.asarray(mask_input, dtype=np.float32)[None, :, :, :]
+            has_mask_input = np.ones(1, dtype=np.float32)
+
+        masks, iou_predictions, low_res_masks = self.decoder.run(
+            None,
+            {
+                "image_embeddings": self.features,
+                "point_coords": coords[None, :, :].astype(np.float32),
+                "point_labels": labels[None, :],
+                "mask_input": mask_input,
+                "has_mask_input": has_mask_input,
+                "orig_im_size": np.array(self.original_size, dtype=np.float32),
+            },
+        )
+
+        # Select the correct mask or masks for output, as in MaskDecoder.forward
+        mask_slice = slice(1, None) if multimask_output else slice(0, 1)
+        masks = masks[0, mask_slice]
+        if not return_logits:
+            masks = masks > self.mask_threshold
+        return masks, iou_predictions[0, mask_slice], low_res_masks[0, mask_slice]
+
+    def get_image_embedding(self) -> np.ndarray:
+        """Returns the image embeddings for the currently set image, as 1xCxHxW."""
+        if not self.is_image_set:
+            raise RuntimeError(
+                "An image must be set with .set_image(...) to generate an embedding."
+            )
+        return self.features
+
+    def apply_coords(self, coords: np.ndarray, original_size: Tuple[int, ...]) -> np.ndarray:
+        """Same as ResizeLongestSide.apply_coords."""
+        old_h, old_w = original_size
+        new_h, new_w = self.get_preprocess_shape(old_h, old_w, self.img_size)
+        coords = coords.astype(float)
+        coords[..., 0] = coords[..., 0] * (new_w / old_w)
+        coords[..., 1] = coords[..., 1] * (new_h / old_h)
+        return coords
+
+    @staticmethod
+    def get_preprocess_shape(oldh: int, oldw: int, long_side_length: int) -> Tuple[int, int]:
+        """Same as ResizeLongestSide.get_preprocess_shape."""
+        scale = long_side_length * 1.0 / max(oldh, oldw)
+        newh, neww = oldh * scale, oldw * scale
+        neww = int(neww + 0.5)
+        newh = int(newh + 0.5)
+        return (newh, neww)
+
+    def reset_image(self) -> None:
+        """Resets the currently set image."""
+        self.is_image_set = False
+        self.features = None
+        self.original_size = None
+        self.input_size = None
@@ -7,17 +7,34 @@
 import numpy as np
 import torch
 
+import threading
+
 from segment_anything.modeling import Sam
 
-from typing import Optional, Tuple
+from typing import List, NamedTuple, Optional, Tuple
 
+from .utils.embedding_store import EmbeddingStore
 from .utils.transforms import ResizeLongestSide
 
 
+class ImageEmbedding(NamedTuple):
+    """
+    The image embedding of a single image, together with the sizes needed
+    to map prompts and masks between the original and input frames. Pass
+    it to 'predict_with_embedding', or restore it on a predictor with
+    'set_embedding(*embedding)'.
+    """
+
+    features: torch.Tensor  # 1xCxHxW
+    original_size: Tuple[int, ...]  # (H, W) before ResizeLongestSide
+    input_size: Tuple[int, ...]  # (H, W) after ResizeLongestSide
+
+
 class SamPredictor:
     def __init__(
         self,
         sam_model: Sam,
+        embedding_store: Optional[EmbeddingStore] = None,
     ) -> None:
         """
         Uses SAM to calculate the image embedding for an image, and then
@@ -25,10 +42,16 @@ class SamPredictor:
 
         Arguments:
           sam_model (Sam): The model to use for mask prediction.
+          embedding_store (EmbeddingStore or None): If given, 'set_image'
+            looks up image embeddings in this store before running the
+            image encoder, and writes newly computed embeddings to it.
         """
         super().__init__()
         self.model = sam_model
         self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
+        self.embedding_store = embedding_store
+        # Per-thread encoder input buffer, reused across images
+        self._buffers = threading.local()
         self.reset_image()
 
     def set_image(
@@ -49,15 +72,123 @@ class SamPredictor:
             "RGB",
             "BGR",
         ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
-        if image_format != self.model.image_format:
-            image = image[..., ::-1]
+        self.set_embedding(*self.encode(image, image_format))
+
+    @torch.no_grad()
+    def encode(
+        self,
+        image: np.ndarray,
+        image_format: str = "RGB",
+    ) -> ImageEmbedding:
+        """
+        Calculates the image embedding for the provided image without
+        changing the predictor's state. The returned handle can be passed
+        to 'predict_with_embedding' from any number of threads at once.
+
+        Arguments:
+          image (np.ndarray): The image for calculating masks. Expects an
+            image in HWC uint8 format, with pixel values in [0, 255].
+          image_format (str): The color format of the image, in ['RGB', 'BGR'].
+
+        Returns:
+          (ImageEmbedding): The image embedding and sizes of the image.
+            Its features must not be modified in place.
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        key = None
+        if self.embedding_store is not None:
+            key = EmbeddingStore.image_key(image, image_format)
+            cached = self.embedding_store.get(key, device=self.device)
+            if cached is not None:
+                return ImageEmbedding(*cached)
+
+        input_image_torch = self._transform_image(image, image_format)
+        embedding = self.encode_torch(input_image_torch, image.shape[:2])
+
+        if key is not None:
+            self.embedding_store.put(key, *embedding)
+        return embedding
+
+    @torch.no_grad()
+    def encode_batch(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+        batch_size: Optional[int] = None,
+    ) -> List[ImageEmbedding]:
+        """
+        Calculates the image embeddings for several images, running the image
+        encoder on all of them in a single batched forward pass. Does not
+        change the currently set image.
 
-        # Transform the image to the form expected by the model
-        input_image = self.transform.apply_image(image)
-        input_image_torch = torch.as_tensor(input_image, device=self.device)
-        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+        Arguments:
+          images (list(np.ndarray)): The images to embed, each in HWC uint8
+            format with pixel values in [0, 255]. Sizes may differ.
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+          batch_size (int or None): The maximum number of images per encoder
+            pass. If None, all images are encoded together.
+
+        Returns:
+          (list(ImageEmbedding)): One embedding per input image, in order.
+            Pass one to 'predict_with_embedding' to predict masks for that
+            image.
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        embeddings: List[Optional[ImageEmbedding]] = [None] * len(images)
+        keys: List[Optional[str]] = [None] * len(images)
+        if self.embedding_store is not None:
+            for i, image in enumerate(images):
+                keys[i] = EmbeddingStore.image_key(image, image_format)
+                cached = self.embedding_store.get(keys[i], device=self.device)
+                if cached is not None:
+                    embeddings[i] = ImageEmbedding(*cached)
+
+        to_encode = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        batch_size = batch_size or max(len(to_encode), 1)
+        for start in range(0, len(to_encode), batch_size):
+            batch_idxs = to_encode[start : start + batch_size]
+            input_images = self._get_input_buffer(len(batch_idxs))
+            input_sizes = []
+            for j, i in enumerate(batch_idxs):
+                input_image_torch = self._transform_image(images[i], image_format)
+                input_sizes.append(tuple(input_image_torch.shape[-2:]))
+                self.model.preprocess(input_image_torch, out=input_images[j : j + 1])
+            features = self.model.image_encoder(input_images)
+
+            for i, input_size, curr_features in zip(batch_idxs, input_sizes, features):
+                embedding = ImageEmbedding(curr_features[None], images[i].shape[:2], input_size)
+                if keys[i] is not None:
+                    self.embedding_store.put(keys[i], *embedding)
+                embeddings[i] = embedding
+
+        return embeddings  # type: ignore
+
+    def _transform_image(self, image: np.ndarray, image_format: str) -> torch.Tensor:
+        """Transforms an HWC uint8 image to a 1x3xHxW tensor in the model's color format."""
+        input_image_torch = self.transform.apply_image_to_torch(image)
+        # Swapping channels after the resize copies far fewer pixels
+        if image_format != self.model.image_format:
+            input_image_torch = input_image_torch.flip(1)
+        return input_image_torch.to(self.device)
 
-        self.set_torch_image(input_image_torch, image.shape[:2])
+    def _get_input_buffer(self, batch_size: int) -> torch.Tensor:
+        """
+        Returns a Bx3xSxS float tensor for preprocessed encoder inputs, reusing
+        the memory of earlier calls from this thread. Its contents are only
+        valid until the next call.
+        """
+        img_size = self.model.image_encoder.img_size
+        buffer = getattr(self._buffers, "input", None)
+        if buffer is None or len(buffer) < batch_size or buffer.device != self.device:
+            buffer = torch.empty((batch_size, 3, img_size, img_size), device=self.device)
+            self._buffers.input = buffer
+        return buffer[:batch_size]
 
     @torch.no_grad()
     def set_torch_image(
@@ -81,12 +212,58 @@ class SamPredictor:
             and transformed_image.shape[1] == 3
             and max(*transformed_image.shape[2:]) == self.model.image_encoder.img_size
         ), f"set_torch_image input must be BCHW with long side {self.model.image_encoder.img_size}."
+        self.set_embedding(*self.encode_torch(transformed_image, original_image_size))
+
+    @torch.no_grad()
+    def encode_torch(
+        self,
+        transformed_image: torch.Tensor,
+        original_image_size: Tuple[int, ...],
+    ) -> ImageEmbedding:
+        """
+        Calculates the image embedding for an image already transformed to
+        the format expected by the model, without changing the predictor's
+        state. See 'set_torch_image' for the arguments.
+        """
+        assert (
+            len(transformed_image.shape) == 4
+            and transformed_image.shape[1] == 3
+            and max(*transformed_image.shape[2:]) == self.model.image_encoder.img_size
+        ), f"encode_torch input must be BCHW with long side {self.model.image_encoder.img_size}."
+        input_image = self._get_input_buffer(len(transformed_image))
+        self.model.preprocess(transformed_image, out=input_image)
+        features = self.model.image_encoder(input_image)
+        return ImageEmbedding(features, tuple(original_image_size), tuple(transformed_image.shape[-2:]))
+
+    def set_embedding(
+        self,
+        features: torch.Tensor,
+        original_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Sets a previously computed image embedding, allowing masks to be
+        predicted with the 'predict' method without running the image encoder.
+
+        Arguments:
+          features (torch.Tensor): The image embedding, with shape 1xCxHxW,
+            as returned by 'get_image_embedding'.
+          original_size (tuple(int, int)): The size of the image before
+            transformation, in (H, W) format.
+          input_size (tuple(int, int)): The size of the image after
+            transformation with ResizeLongestSide, in (H, W) format.
+        """
+        assert (
+            len(features.shape) == 4 and features.shape[0] == 1
+        ), "set_embedding input must be 1xCxHxW."
+        assert (
+            max(*input_size) == self.model.image_encoder.img_size
+        ), f"input_size must have long side {self.model.image_encoder.img_size}."
         self.reset_image()
 
-        self.original_size = original_image_size
-        self.input_size = tuple(transformed_image.shape[-2:])
-        input_image = self.model.preprocess(transformed_image)
-        self.features = self.model.image_encoder(input_image)
+        self.original_size = tuple(original_size)
+        self.input_size = tuple(input_size)
+        self.features = features.to(device=self.device, dtype=torch.float32)
         self.is_image_set = True
 
     def predict(
@@ -97,11 +274,44 @@ class SamPredictor:
         mask_input: Optional[np.ndarray] = None,
         multimask_output: bool = True,
         return_logits: bool = False,
+        num_masks: Optional[int] = None,
+        postprocess: str = "exact",
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
         Predict masks for the given input prompts, using the currently set image.
+        See 'predict_with_embedding' for the arguments and outputs.
+        """
+        return self.predict_with_embedding(
+            self._current_embedding(),
+            point_coords,
+            point_labels,
+            box,
+            mask_input,
+            multimask_output,
+            return_logits=return_logits,
+            num_masks=num_masks,
+            postprocess=postprocess,
+        )
+
+    def predict_with_embedding(
+        self,
+        embedding: ImageEmbedding,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        box: Optional[np.ndarray] = None,
+        mask_input: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+        num_masks: Optional[int] = None,
+        postprocess: str = "exact",
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Predict masks for the given input prompts on an image embedding from
+        'encode'. Does not use or change the predictor's state, so it is safe
+        to call from several threads at once.
 
         Arguments:
+          embedding (ImageEmbedding): The image embedding to predict on.
           point_coords (np.ndarray or None): A Nx2 array of point prompts to the
             model. Each point is in (X,Y) in pixels.
           point_labels (np.ndarray or None): A length N array of labels for the
@@ -120,6 +330,11 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          num_masks (int or None): If given, only the num_masks masks with
+            the highest predicted quality are returned, best first, and only
+            those are upscaled. See predict_torch_with_embedding.
+          postprocess (str): How masks are upscaled to the image size, in
+            ['exact', 'fused', 'fused_box']. See predict_torch_with_embedding.
 
         Returns:
           (np.ndarray): The output masks in CxHxW format, where C is the
@@ -130,34 +345,34 @@ class SamPredictor:
             of masks and H=W=256. These low resolution logits can be passed to
             a subsequent iteration as mask input.
         """
-        if not self.is_image_set:
-            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
-
         # Transform input prompts
         coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
         if point_coords is not None:
             assert (
                 point_labels is not None
             ), "point_labels must be supplied if point_coords is supplied."
-            point_coords = self.transform.apply_coords(point_coords, self.original_size)
+            point_coords = self.transform.apply_coords(point_coords, embedding.original_size)
             coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)
             labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)
             coords_torch, labels_torch = coords_torch[None, :, :], labels_torch[None, :]
         if box is not None:
-            box = self.transform.apply_boxes(box, self.original_size)
+            box = self.transform.apply_boxes(box, embedding.original_size)
             box_torch = torch.as_tensor(box, dtype=torch.float, device=self.device)
             box_torch = box_torch[None, :]
         if mask_input is not None:
             mask_input_torch = torch.as_tensor(mask_input, dtype=torch.float, device=self.device)
             mask_input_torch = mask_input_torch[None, :, :, :]
 
-        masks, iou_predictions, low_res_masks = self.predict_torch(
+        masks, iou_predictions, low_res_masks = self.predict_torch_with_embedding(
+            embedding,
             coords_torch,
             labels_torch,
             box_torch,
             mask_input_torch,
             multimask_output,
             return_logits=return_logits,
+            num_masks=num_masks,
+            postprocess=postprocess,
         )
 
         masks_np = masks[0].detach().cpu().numpy()
@@ -165,7 +380,6 @@ class SamPredictor:
         low_res_masks_np = low_res_masks[0].detach().cpu().numpy()
         return masks_np, iou_predictions_np, low_res_masks_np
 
-    @torch.no_grad()
     def predict_torch(
         self,
         point_coords: Optional[torch.Tensor],
@@ -174,13 +388,59 @@ class SamPredictor:
         mask_input: Optional[torch.Tensor] = None,
         multimask_output: bool = True,
         return_logits: bool = False,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        upscale_masks: bool = True,
+        sparse_prompt_embeddings: Optional[torch.Tensor] = None,
+        num_masks: Optional[int] = None,
+        postprocess: str = "exact",
+    ) -> Tuple[Optional[torch.Tensor], torch.Tensor, torch.Tensor]:
         """
         Predict masks for the given input prompts, using the currently set image.
         Input prompts are batched torch tensors and are expected to already be
+        transformed to the input frame using ResizeLongestSide. See
+        'predict_torch_with_embedding' for the arguments and outputs.
+        """
+        return self.predict_torch_with_embedding(
+            self._current_embedding(),
+            point_coords,
+            point_labels,
+            boxes,
+            mask_input,
+            multimask_output,
+            return_logits=return_logits,
+            upscale_masks=upscale_masks,
+            sparse_prompt_embeddings=sparse_prompt_embeddings,
+            num_masks=num_masks,
+            postprocess=postprocess,
+        )
+
+    def _current_embedding(self) -> ImageEmbedding:
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        return ImageEmbedding(self.features, self.original_size, self.input_size)
+
+    @torch.no_grad()
+    def predict_torch_with_embedding(
+        self,
+        embedding: ImageEmbedding,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor] = None,
+        mask_input: Optional[torch.Tensor] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+        upscale_masks: bool = True,
+        sparse_prompt_embeddings: Optional[torch.Tensor] = None,
+        num_masks: Optional[int] = None,
+        postprocess: str = "exact",
+    ) -> Tuple[Optional[torch.Tensor], torch.Tensor, torch.Tensor]:
+        """
+        Predict masks for the given input prompts on an image embedding from
+        'encode', without using or changing the predictor's state. Input
+        prompts are batched torch tensors and are expected to already be
         transformed to the input frame using ResizeLongestSide.
 
         Arguments:
+          embedding (ImageEmbedding): The image embedding to predict on.
           point_coords (torch.Tensor or None): A BxNx2 array of point prompts to the
             model. Each point is in (X,Y) in pixels.
           point_labels (torch.Tensor or None): A BxN array of labels for the
@@ -200,18 +460,35 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          upscale_masks (bool): If false, skips upscaling the masks to the
+            original image size and returns None in their place. Use this
+            when only the low res logits are needed.
+          sparse_prompt_embeddings (torch.Tensor or None): Precomputed sparse
+            embeddings of the point and box prompts, as returned by the
+            model's prompt encoder, with shape BxNx(embed_dim). If given,
+            point_coords, point_labels and boxes must be None.
+          num_masks (int or None): If given, only the num_masks masks with
+            the highest predicted quality are kept per prompt, sorted best
+            first, before any upscaling. C in the outputs is then num_masks.
+          postprocess (str): How masks are upscaled to the image size.
+            'exact' is Sam.postprocess_masks. 'fused' resizes once, straight
+            from the low res masks, and 'fused_box' additionally only within
+            each mask's bounding box; see Sam.postprocess_masks_fused.
 
         Returns:
-          (torch.Tensor): The output masks in BxCxHxW format, where C is the
-            number of masks, and (H, W) is the original image size.
+          (torch.Tensor or None): The output masks in BxCxHxW format, where C
+            is the number of masks, and (H, W) is the original image size.
           (torch.Tensor): An array of shape BxC containing the model's
             predictions for the quality of each mask.
           (torch.Tensor): An array of shape BxCxHxW, where C is the number
             of masks and H=W=256. These low res logits can be passed to
             a subsequent iteration as mask input.
         """
-        if not self.is_image_set:
-            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        assert postprocess in [
+            "exact",
+            "fused",
+            "fused_box",
+        ], f"Unknown postprocess {postprocess}."
 
         if point_coords is not None:
             points = (point_coords, point_labels)
@@ -219,23 +496,51 @@ class SamPredictor:
             points = None
 
         # Embed prompts
-        sparse_embeddings, dense_embeddings = self.model.prompt_encoder(
-            points=points,
-            boxes=boxes,
-            masks=mask_input,
-        )
+        if sparse_prompt_embeddings is None:
+            sparse_embeddings, dense_embeddings = self.model.prompt_encoder(
+                points=points,
+                boxes=boxes,
+                masks=mask_input,
+            )
+        else:
+            assert (
+                points is None and boxes is None
+            ), "Prompts can't be given along with sparse_prompt_embeddings."
+            # Only the dense embedding is needed; without a mask input it is
+            # the same for every prompt and broadcasts over the batch.
+            sparse_embeddings = sparse_prompt_embeddings
+            _, dense_embeddings = self.model.prompt_encoder(
+                points=None, boxes=None, masks=mask_input
+            )
 
         # Predict masks
         low_res_masks, iou_predictions = self.model.mask_decoder(
-            image_embeddings=self.features,
+            image_embeddings=embedding.features,
             image_pe=self.model.prompt_encoder.get_dense_pe(),
             sparse_prompt_embeddings=sparse_embeddings,
             dense_prompt_embeddings=dense_embeddings,
             multimask_output=multimask_output,
         )
 
+        # Keep the best masks before upscaling anything
+        if num_masks is not None:
+            order = torch.argsort(iou_predictions, dim=1, descending=True)[:, :num_masks]
+            iou_predictions = torch.gather(iou_predictions, 1, order)
+            low_res_masks = low_res_masks[torch.arange(len(order), device=order.device)[:, None], order]
+
+        if not upscale_masks:
+            return None, iou_predictions, low_res_masks
+
         # Upscale the masks to the original image resolution
-        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        if postprocess == "exact":
+            masks = self.model.postprocess_masks(low_res_masks, embedding.input_size, embedding.original_size)
+        else:
+            masks = self.model.postprocess_masks_fused(
+                low_res_masks,
+                embedding.input_size,
+                embedding.original_size,
+                crop_to_box=(postprocess == "fused_box"),
+            )
 
         if not return_logits:
             masks = masks > self.model.mask_threshold
@@ -10,21 +10,30 @@ import torch
 import math
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from typing import Any, Dict, Generator, ItemsView, List, Optional, Tuple
 
 
 class MaskData:
     """
     A structure for storing masks and their related data in batched format.
     Implements basic filtering and concatenation.
+
+    Data is stored by column. Tensor and array columns grown with 'cat'
+    are backed by buffers with spare capacity that double when full, so
+    building up data over many batches and crops takes amortized linear
+    time. Masks are kept bit-packed under 'packed_masks' (see pack_masks),
+    with their (H, W) in 'mask_size'.
     """
 
-    def __init__(self, **kwargs) -> None:
+    def __init__(self, mask_size: Optional[Tuple[int, int]] = None, **kwargs) -> None:
         for v in kwargs.values():
             assert isinstance(
                 v, (list, np.ndarray, torch.Tensor)
             ), "MaskData only supports list, numpy arrays, and torch tensors."
         self._stats = dict(**kwargs)
+        self.mask_size = None if mask_size is None else tuple(mask_size)
+        # Column name -> (backing buffer, the view of it last stored in _stats)
+        self._buffers: Dict[str, Tuple[Any, Any]] = {}
 
     def __setitem__(self, key: str, item: Any) -> None:
         assert isinstance(
@@ -34,45 +43,134 @@ class MaskData:
 
     def __delitem__(self, key: str) -> None:
         del self._stats[key]
+        self._buffers.pop(key, None)
 
     def __getitem__(self, key: str) -> Any:
         return self._stats[key]
 
+    def __contains__(self, key: str) -> bool:
+        return key in self._stats
+
     def items(self) -> ItemsView[str, Any]:
         return self._stats.items()
 
     def filter(self, keep: torch.Tensor) -> None:
+        # Resolve keep to indices once, on each device it's needed on
+        keep = torch.as_tensor(keep)
+        if keep.dtype == torch.bool:
+            keep = keep.nonzero()[:, 0]
+        keep_by_device: Dict[torch.device, torch.Tensor] = {keep.device: keep}
+        keep_np = keep.detach().cpu().numpy()
         for k, v in self._stats.items():
             if v is None:
                 self._stats[k] = None
             elif isinstance(v, torch.Tensor):
-                self._stats[k] = v[torch.as_tensor(keep, device=v.device)]
+                if v.device not in keep_by_device:
+                    keep_by_device[v.device] = keep.to(v.device)
+                self._stats[k] = v[keep_by_device[v.device]]
             elif isinstance(v, np.ndarray):
-                self._stats[k] = v[keep.detach().cpu().numpy()]
-            elif isinstance(v, list) and keep.dtype == torch.bool:
-                self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
+                self._stats[k] = v[keep_np]
             elif isinstance(v, list):
-                self._stats[k] = [v[i] for i in keep]
+                self._stats[k] = [v[i] for i in keep_np]
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
+        self._buffers.clear()
 
     def cat(self, new_stats: "MaskData") -> None:
+        self._cat_mask_size(new_stats.mask_size)
         for k, v in new_stats.items():
             if k not in self._stats or self._stats[k] is None:
                 self._stats[k] = deepcopy(v)
+            elif isinstance(v, (torch.Tensor, np.ndarray)):
+                self._stats[k] = self._append(k, self._stats[k], v)
+            elif isinstance(v, list):
+                self._stats[k] = self._append(k, self._stats[k], deepcopy(v))
+            else:
+                raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
+
+    def _cat_mask_size(self, mask_size: Optional[Tuple[int, int]]) -> None:
+        if mask_size is None:
+            return
+        assert (
+            self.mask_size is None or self.mask_size == mask_size
+        ), f"Can't combine masks of size {self.mask_size} and {mask_size}."
+        self.mask_size = mask_size
+
+    def _append(self, k: str, old: Any, new: Any) -> Any:
+        """
+        Returns old with new appended, writing into the column's buffer if
+        old is its current view and there is room, and otherwise into a new
+        buffer with twice the capacity.
+        """
+        buffer, view = self._buffers.get(k, (None, None))
+        n, m = len(old), len(new)
+        if isinstance(old, list):
+            if old is not view:
+                old = list(old)
+            old.extend(new)
+            self._buffers[k] = (old, old)
+            return old
+
+        reusable = (
+            view is old
+            and type(new) is type(buffer)
+            and new.dtype == buffer.dtype
+            and new.shape[1:] == buffer.shape[1:]
+            and (not isinstance(new, torch.Tensor) or new.device == buffer.device)
+            and len(buffer) >= n + m
+        )
+        if not reusable:
+            shape = (max(n + m, 2 * n), *old.shape[1:])
+            if isinstance(old, torch.Tensor):
+                new = torch.as_tensor(new, device=old.device)
+                dtype = torch.promote_types(old.dtype, new.dtype)
+                buffer = torch.empty(shape, dtype=dtype, device=old.device)
+            else:
+                buffer = np.empty(shape, dtype=np.result_type(old.dtype, new.dtype))
+            buffer[:n] = old
+        buffer[n : n + m] = new
+        view = buffer[: n + m]
+        self._buffers[k] = (buffer, view)
+        return view
+
+    @classmethod
+    def concat(cls, items: List["MaskData"]) -> "MaskData":
+        """
+        Concatenates several MaskData with the same keys at once, copying
+        each value a single time instead of once per 'cat'.
+        """
+        data = cls()
+        if len(items) == 0:
+            return data
+        for item in items:
+            data._cat_mask_size(item.mask_size)
+        for k, v in items[0].items():
+            values = [item[k] for item in items]
+            if v is None:
+                data._stats[k] = None
             elif isinstance(v, torch.Tensor):
-                self._stats[k] = torch.cat([self._stats[k], v], dim=0)
+                data[k] = torch.cat(values, dim=0)
             elif isinstance(v, np.ndarray):
-                self._stats[k] = np.concatenate([self._stats[k], v], axis=0)
+                data[k] = np.concatenate(values, axis=0)
             elif isinstance(v, list):
-                self._stats[k] = self._stats[k] + deepcopy(v)
+                data[k] = [a for value in values for a in value]
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
+        return data
 
     def to_numpy(self) -> None:
         for k, v in self._stats.items():
             if isinstance(v, torch.Tensor):
                 self._stats[k] = v.detach().cpu().numpy()
+        self._buffers.clear()
+
+    def get_mask(self, idx: int) -> np.ndarray:
+        """Returns mask idx as an HxW boolean array, unpacked from 'packed_masks'."""
+        assert self.mask_size is not None, "MaskData has no packed masks."
+        packed = self._stats["packed_masks"][idx]
+        if isinstance(packed, torch.Tensor):
+            packed = packed.detach().cpu().numpy()
+        return unpack_mask(packed, self.mask_size)
 
 
 def is_box_near_crop_edge(
@@ -113,24 +211,32 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     b, h, w = tensor.shape
     tensor = tensor.permute(0, 2, 1).flatten(1)
 
-    # Compute change indices
+    # Compute change indices, sorted by mask
     diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
+    rows, cols = diff.nonzero().unbind(1)
+
+    # Run boundaries of all masks in one flat tensor. Mask i owns the
+    # n_i + 2 entries starting at offsets[i]: 0, each change index + 1, h*w.
+    n_changes = torch.bincount(rows, minlength=b)
+    n_bounds = n_changes + 2
+    offsets = torch.cumsum(n_bounds, 0) - n_bounds
+    first_change = torch.cumsum(n_changes, 0) - n_changes
+    bounds = torch.full((int(n_bounds.sum()),), h * w, dtype=cols.dtype, device=cols.device)
+    bounds[offsets] = 0
+    change_pos = torch.arange(len(rows), device=cols.device) - first_change[rows]
+    bounds[offsets[rows] + 1 + change_pos] = cols + 1
+
+    # Run lengths; the entries that straddle two masks are never read
+    btw_idxs = (bounds[1:] - bounds[:-1]).cpu().tolist()
+    offsets = offsets.cpu().tolist()
+    n_changes = n_changes.cpu().tolist()
+    starts_on = tensor[:, 0].cpu().tolist()
 
     # Encode run length
     out = []
     for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
+        counts = [0] if starts_on[i] else []
+        counts.extend(btw_idxs[offsets[i] : offsets[i] + n_changes[i] + 1])
         out.append({"size": [h, w], "counts": counts})
     return out
 
@@ -138,13 +244,9 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    # Runs alternate between background and foreground, starting with background
+    parity = np.arange(len(rle["counts"])) % 2 == 1
+    mask = np.repeat(parity, rle["counts"])
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
@@ -153,6 +255,60 @@ def area_from_rle(rle: Dict[str, Any]) -> int:
     return sum(rle["counts"][1::2])
 
 
+def pack_masks(masks: torch.Tensor) -> torch.Tensor:
+    """
+    Bit-packs a batch of BxHxW binary masks to a Bx(ceil(H*W/8)) uint8
+    tensor, 8x smaller than bool. Pixels are in C order and bits in the
+    same order as np.packbits, so a row can be read with unpack_mask.
+    """
+    b = masks.shape[0]
+    flat = masks.flatten(1).to(torch.uint8)
+    pad = -flat.shape[1] % 8
+    if pad:
+        flat = torch.nn.functional.pad(flat, (0, pad))
+    bits = flat.view(b, flat.shape[1] // 8, 8)
+    packed = bits[..., 0] << 7
+    for i in range(1, 8):
+        packed |= bits[..., i] << (7 - i)
+    return packed
+
+
+def unpack_mask(packed: np.ndarray, mask_size: Tuple[int, ...]) -> np.ndarray:
+    """Inverse of pack_masks for a single mask; returns an HxW boolean array."""
+    h, w = mask_size
+    return np.unpackbits(packed, count=h * w).reshape(h, w).view(bool)
+
+
+def unpack_mask_rows(
+    packed: np.ndarray, mask_size: Tuple[int, ...], y0: int, y1: int
+) -> np.ndarray:
+    """Unpacks only rows [y0, y1) of a mask packed with pack_masks, as a boolean array."""
+    _, w = mask_size
+    start, stop = y0 * w, y1 * w
+    bits = np.unpackbits(packed[start // 8 : -(-stop // 8)])
+    return bits[start % 8 : start % 8 + stop - start].reshape(y1 - y0, w).view(bool)
+
+
+def pack_mask_rows(
+    packed: np.ndarray, mask_size: Tuple[int, ...], y0: int, rows: np.ndarray
+) -> None:
+    """Writes rows starting at row y0 into a mask packed with pack_masks, in place."""
+    _, w = mask_size
+    start, stop = y0 * w, (y0 + len(rows)) * w
+    first, last = start // 8, -(-stop // 8)
+    bits = np.unpackbits(packed[first:last])
+    bits[start % 8 : start % 8 + stop - start] = rows.ravel()
+    packed[first:last] = np.packbits(bits)
+
+
+def unpack_masks(packed: torch.Tensor, mask_size: Tuple[int, ...]) -> torch.Tensor:
+    """Inverse of pack_masks; returns BxHxW boolean masks on packed's device."""
+    h, w = mask_size
+    shifts = torch.arange(7, -1, -1, device=packed.device, dtype=torch.uint8)
+    bits = (packed[..., None] >> shifts) & 1
+    return bits.flatten(1)[:, : h * w].reshape(len(packed), h, w).bool()
+
+
 def calculate_stability_score(
     masks: torch.Tensor, mask_threshold: float, threshold_offset: float
 ) -> torch.Tensor:
@@ -197,6 +353,55 @@ def build_all_layer_point_grids(
     return points_by_layer
 
 
+def estimate_foreground(image: np.ndarray, background_tol: int = 20) -> np.ndarray:
+    """
+    Cheap foreground estimate for an object on a plain background. Pixels
+    within background_tol of the median border color in every channel and
+    connected to the image border are background. Everything else is
+    foreground, including background-colored regions enclosed by the object.
+    Returns an HxW boolean mask. Requires opencv.
+    """
+    import cv2  # type: ignore
+
+    border = np.concatenate([image[0], image[-1], image[:, 0], image[:, -1]])
+    background_color = np.median(border, axis=0)
+    diff = np.abs(image.astype(np.int16) - background_color.astype(np.int16)).max(axis=-1)
+    _, regions = cv2.connectedComponents((diff <= background_tol).astype(np.uint8), connectivity=4)
+    border_labels = np.unique(
+        np.concatenate([regions[0], regions[-1], regions[:, 0], regions[:, -1]])
+    )
+    border_labels = border_labels[border_labels != 0]  # Label 0 is the non-background pixels
+    return ~np.isin(regions, border_labels)
+
+
+def build_foreground_point_grid(foreground: np.ndarray, n_points: int) -> np.ndarray:
+    """
+    Generates up to n_points points evenly spaced over the foreground of an
+    HxW mask, normalized to [0,1]x[0,1] like build_point_grid. Returns an
+    empty array if the mask has no foreground.
+    """
+    ys, xs = np.nonzero(foreground)
+    if len(xs) == 0:
+        return np.zeros((0, 2))
+    h, w = foreground.shape
+    x0, y0, x1, y1 = xs.min(), ys.min(), xs.max() + 1, ys.max() + 1
+
+    # Start from a grid over the foreground's box just dense enough that
+    # about n_points of its points land on the foreground, and thin it out
+    # until they fit the budget
+    fill_ratio = len(xs) / ((x1 - x0) * (y1 - y0))
+    n_per_side = max(1, int(math.ceil(math.sqrt(n_points / fill_ratio))))
+    while True:
+        grid = build_point_grid(n_per_side) * np.array([x1 - x0, y1 - y0]) + np.array([x0, y0])
+        points = grid[foreground[grid[:, 1].astype(int), grid[:, 0].astype(int)]]
+        if len(points) <= n_points or n_per_side == 1:
+            break
+        n_per_side -= 1
+    if len(points) == 0:
+        points = np.array([[xs.mean(), ys.mean()]])
+    return points / np.array([w, h])
+
+
 def generate_crop_boxes(
     im_size: Tuple[int, ...], n_layers: int, overlap_ratio: float
 ) -> Tuple[List[List[int]], List[int]]:
@@ -253,11 +458,24 @@ def uncrop_points(points: torch.Tensor, crop_box: List[int]) -> torch.Tensor:
 
 
 def uncrop_masks(
-    masks: torch.Tensor, crop_box: List[int], orig_h: int, orig_w: int
+    masks: torch.Tensor,
+    crop_box: List[int],
+    orig_h: int,
+    orig_w: int,
+    out: Optional[torch.Tensor] = None,
 ) -> torch.Tensor:
+    """
+    Pads masks in a crop's frame to the original image. If given, out is
+    a preallocated Bx(orig_h)x(orig_w) tensor that is written to instead
+    of allocating a new one.
+    """
     x0, y0, x1, y1 = crop_box
     if x0 == 0 and y0 == 0 and x1 == orig_w and y1 == orig_h:
         return masks
+    if out is not None:
+        out.zero_()
+        out[:, y0:y1, x0:x1] = masks
+        return out
     # Coordinate transform masks
     pad_x, pad_y = orig_w - (x1 - x0), orig_h - (y1 - y0)
     pad = (x0, pad_x - x0, y0, pad_y - y0)
@@ -291,6 +509,119 @@ def remove_small_regions(
     return mask, True
 
 
+def remove_small_regions_packed(
+    packed: np.ndarray, mask_size: Tuple[int, ...], box: List[int], area_thresh: float
+) -> Optional[Tuple[np.ndarray, List[int]]]:
+    """
+    Runs remove_small_regions for holes, then islands, on one mask packed
+    with pack_masks, and writes the result back into packed. box is the
+    mask's bounding box in XYXY format. Only the box padded by one or two
+    pixels is unpacked and searched for regions, unless the background
+    outside of it could contain a hole smaller than area_thresh, in which
+    case the whole mask is. Returns None if the mask is unchanged, and
+    otherwise the searched region of the cleaned mask and its XYXY box,
+    exclusive.
+    """
+    (cx0, cy0, cx1, cy1), padded_edges = _small_region_search_box(box, mask_size, area_thresh)
+    rows = unpack_mask_rows(packed, mask_size, cy0, cy1)
+    new_crop, changed = _remove_small_regions_in_search_box(
+        rows[:, cx0:cx1], padded_edges, area_thresh
+    )
+    if not changed:
+        return None
+
+    rows = rows.copy()
+    rows[:, cx0:cx1] = new_crop
+    pack_mask_rows(packed, mask_size, cy0, rows)
+    return new_crop, [cx0, cy0, cx1, cy1]
+
+
+def remove_small_regions_in_box(
+    box_mask: np.ndarray, box: List[int], mask_size: Tuple[int, ...], area_thresh: float
+) -> Optional[Tuple[np.ndarray, List[int]]]:
+    """
+    remove_small_regions_packed for a mask given only within its bounding
+    box: box_mask is the part of an HxW mask of mask_size inside box, in
+    XYXY format, and the mask is empty outside of it. Filled holes may lie
+    outside the box, between the mask and the image's edge. Returns None if
+    the mask is unchanged, and otherwise the searched region of the cleaned
+    mask and its XYXY box, exclusive.
+    """
+    (cx0, cy0, cx1, cy1), padded_edges = _small_region_search_box(box, mask_size, area_thresh)
+    x0, y0 = int(box[0]), int(box[1])
+    h, w = box_mask.shape
+    region = np.zeros((cy1 - cy0, cx1 - cx0), dtype=bool)
+    region[y0 - cy0 : y0 - cy0 + h, x0 - cx0 : x0 - cx0 + w] = box_mask
+    new_region, changed = _remove_small_regions_in_search_box(region, padded_edges, area_thresh)
+    if not changed:
+        return None
+    return new_region, [cx0, cy0, cx1, cy1]
+
+
+def _small_region_search_box(
+    box: List[int], mask_size: Tuple[int, ...], area_thresh: float
+) -> Tuple[List[int], List[bool]]:
+    """
+    Returns the XYXY box, exclusive, that small region removal needs to
+    search for a mask with the given bounding box, and which of its edges
+    (top, bottom, left, right) are padding inside the image. This is the
+    box padded by one pixel, unless the background outside of it could
+    contain a hole smaller than area_thresh, in which case it is the whole
+    image. OpenCV labels regions in 2x2 blocks, and ties for the largest
+    island go to the lowest label, so the origin is rounded down to even
+    coordinates to number the islands as in the whole image.
+    """
+    h, w = mask_size
+    x0, y0, x1, y1 = (int(v) for v in box)
+    cx0, cy0 = max(x0 - 1, 0) // 2 * 2, max(y0 - 1, 0) // 2 * 2
+    cx1, cy1 = min(x1 + 2, w), min(y1 + 2, h)
+
+    # The background outside the padded box, as up to two regions; a hole
+    # touching the padding is joined to one of them, so is at least as big
+    spans_width, spans_height = x0 == 0 and x1 == w - 1, y0 == 0 and y1 == h - 1
+    if spans_width and spans_height:
+        outside_areas = []
+    elif spans_width:
+        outside_areas = [a for a, ok in [(cy0 * w, y0 > 0), ((h - cy1) * w, y1 < h - 1)] if ok]
+    elif spans_height:
+        outside_areas = [a for a, ok in [(cx0 * h, x0 > 0), ((w - cx1) * h, x1 < w - 1)] if ok]
+    else:
+        outside_areas = [h * w - (cx1 - cx0) * (cy1 - cy0)]
+    if min(outside_areas, default=area_thresh) < area_thresh:
+        return [0, 0, w, h], [False] * 4
+    return [cx0, cy0, cx1, cy1], [cy0 < y0, cy1 > y1 + 1, cx0 < x0, cx1 > x1 + 1]
+
+
+def _remove_small_regions_in_search_box(
+    mask: np.ndarray, padded_edges: List[bool], area_thresh: float
+) -> Tuple[np.ndarray, bool]:
+    mask, holes_changed = _remove_small_holes(mask, area_thresh, padded_edges)
+    mask, islands_changed = remove_small_regions(mask, area_thresh, mode="islands")
+    return mask, holes_changed or islands_changed
+
+
+def _remove_small_holes(
+    mask: np.ndarray, area_thresh: float, padded_edges: List[bool]
+) -> Tuple[np.ndarray, bool]:
+    """
+    remove_small_regions(mode='holes') for a crop of a mask. Holes touching
+    a padded edge (top, bottom, left, right) continue outside the crop and
+    are never filled.
+    """
+    import cv2  # type: ignore
+
+    n_labels, regions, stats, _ = cv2.connectedComponentsWithStats((~mask).astype(np.uint8), 8)
+    small = stats[:, -1] < area_thresh
+    small[0] = False  # The mask itself
+    edges = [regions[0], regions[-1], regions[:, 0], regions[:, -1]]
+    for padded, edge in zip(padded_edges, edges):
+        if padded:
+            small[edge] = False
+    if not small.any():
+        return mask, False
+    return mask | small[regions], True
+
+
 def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     from pycocotools import mask as mask_utils  # type: ignore
 
@@ -300,14 +631,60 @@ def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     return rle
 
 
+def batched_mask_moments(
+    masks: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Calculates the area, centroid and second order central moments of a
+    batch of CxHxW binary masks, without leaving the tensor side. Returns
+    areas (C), centroids in XY format (Cx2) and central moments as
+    [mu20, mu11, mu02] (Cx3), matching the mu* values of cv2.moments on a
+    0/1 mask. Empty masks have a centroid and moments of 0.
+    """
+    h, w = masks.shape[-2:]
+    device = masks.device
+    xs = torch.arange(w, device=device, dtype=torch.float64)
+    ys = torch.arange(h, device=device, dtype=torch.float64)
+
+    # Per-row pixel counts and x sums. In float32 these sums are exact up
+    # to a width of ~5000 pixels; convert a few masks at a time to bound memory.
+    row_counts = masks.sum(-1, dtype=torch.int32).double()
+    col_counts = masks.sum(-2, dtype=torch.int32).double()
+    row_x_sums = torch.empty_like(row_counts)
+    for i in range(0, len(masks), 16):
+        row_x_sums[i : i + 16] = masks[i : i + 16].float() @ xs.float()
+
+    # Raw moments
+    m00 = row_counts.sum(-1)
+    m10 = col_counts @ xs
+    m01 = row_counts @ ys
+    m20 = col_counts @ (xs * xs)
+    m02 = row_counts @ (ys * ys)
+    m11 = row_x_sums @ ys
+
+    # Central moments
+    safe_m00 = m00.clamp(min=1)
+    cx, cy = m10 / safe_m00, m01 / safe_m00
+    mu20 = m20 - cx * m10
+    mu11 = m11 - cx * m01
+    mu02 = m02 - cy * m01
+
+    areas = m00.long()
+    centroids = torch.stack([cx, cy], dim=-1)
+    central_moments = torch.stack([mu20, mu11, mu02], dim=-1)
+    return areas, centroids, central_moments
+
+
 def batched_mask_to_box(masks: torch.Tensor) -> torch.Tensor:
     """
     Calculates boxes in XYXY format around masks. Return [0,0,0,0] for
     an empty mask. For input shape C1xC2x...xHxW, the output shape is C1xC2x...x4.
     """
-    # torch.max below raises an error on empty inputs, just skip in this case
+    # torch.max below raises an error on empty inputs, just skip in this case.
+    # Integer like the boxes of non-empty masks, so concatenating doesn't
+    # turn them into floats.
     if torch.numel(masks) == 0:
-        return torch.zeros(*masks.shape[:-2], 4, device=masks.device)
+        return torch.zeros(*masks.shape[:-2], 4, dtype=torch.long, device=masks.device)
 
     # Normalize shape to CxHxW
     shape = masks.shape
@@ -0,0 +1,177 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+
+class EmbeddingStore:
+    """
+    A persistent, on-disk store for SAM image embeddings. Entries are keyed
+    by the image content hash and the model type, and the features are saved
+    as quantized .npy files, which are decoded to float32 on lookup. The store
+    can be kept under a size budget by evicting least recently used entries.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        model_type: str,
+        dtype: str = "float16",
+        max_bytes: Optional[int] = None,
+    ) -> None:
+        """
+        Arguments:
+          root (str): Directory the embeddings are written to. A subdirectory
+            is created per model type.
+          model_type (str): The sam_model_registry key of the model that
+            produced the embeddings, e.g. 'vit_b'. Embeddings from different
+            models are never mixed.
+          dtype (str): The storage format of the features, in ['float16',
+            'uint8']. 'uint8' uses a per-channel affine quantization and is
+            half the size of 'float16', at some loss of precision.
+          max_bytes (int or None): If given, 'put' evicts least recently
+            used entries until the model type's directory fits in max_bytes.
+            Lookups count as use.
+        """
+        assert dtype in ["float16", "uint8"], f"dtype must be in ['float16', 'uint8'], is {dtype}."
+        self.root = os.path.join(root, model_type)
+        self.model_type = model_type
+        self.dtype = dtype
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def image_key(image: np.ndarray, image_format: str = "RGB") -> str:
+        """Returns the content hash of an HWC uint8 image."""
+        image = np.ascontiguousarray(image)
+        h = hashlib.sha1()
+        h.update(f"{image.shape}|{image.dtype}|{image_format}".encode())
+        h.update(image.data)
+        return h.hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.root, key)
+        return base + ".npy", base + ".json"
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._paths(key)[1])
+
+    def get(
+        self, key: str, device: Any = "cpu"
+    ) -> Optional[Tuple[torch.Tensor, Tuple[int, ...], Tuple[int, ...]]]:
+        """
+        Loads an embedding from the store.
+
+        Arguments:
+          key (str): The key returned by image_key.
+          device (torch.device): The device to put the features on.
+
+        Returns:
+          (tuple or None): None if the key is not in the store. Otherwise the
+            float32 features in 1xCxHxW format, the original image size and
+            the transformed input size, both in (H, W) format.
+        """
+        npy_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            features = np.load(npy_path)
+            os.utime(meta_path)
+        except FileNotFoundError:  # Not stored, or evicted meanwhile
+            return None
+
+        if meta["dtype"] == "uint8":
+            scale = np.asarray(meta["scale"], dtype=np.float32).reshape(1, -1, 1, 1)
+            offset = np.asarray(meta["offset"], dtype=np.float32).reshape(1, -1, 1, 1)
+            features = features * scale + offset
+        else:
+            features = features.astype(np.float32)
+
+        return (
+            torch.as_tensor(features, device=device),
+            tuple(meta["original_size"]),
+            tuple(meta["input_size"]),
+        )
+
+    def put(
+        self,
+        key: str,
+        features: torch.Tensor,
+        original_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Writes an embedding to the store. The features file is written before
+        its metadata, and both are moved into place atomically, so readers
+        never see a partial entry.
+        """
+        feats = features.detach().cpu().float().numpy()
+        meta: Dict[str, Any] = {
+            "model_type": self.model_type,
+            "dtype": self.dtype,
+            "original_size": [int(s) for s in original_size],
+            "input_size": [int(s) for s in input_size],
+        }
+        if self.dtype == "uint8":
+            lo = feats.min(axis=(0, 2, 3))
+            hi = feats.max(axis=(0, 2, 3))
+            scale = np.maximum(hi - lo, 1e-8) / 255.0
+            quantized = np.round((feats - lo.reshape(1, -1, 1, 1)) / scale.reshape(1, -1, 1, 1))
+            stored = np.clip(quantized, 0, 255).astype(np.uint8)
+            meta["scale"] = scale.tolist()
+            meta["offset"] = lo.tolist()
+        else:
+            stored = feats.astype(np.float16)
+
+        npy_path, meta_path = self._paths(key)
+        self._atomic_write(npy_path, lambda f: np.save(f, stored), binary=True)
+        self._atomic_write(meta_path, lambda f: json.dump(meta, f), binary=False)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes: int) -> None:
+        """Deletes least recently used entries until the store fits in max_bytes."""
+        entries = []
+        for fname in os.listdir(self.root):
+            if not fname.endswith(".json"):
+                continue
+            npy_path, meta_path = self._paths(fname[: -len(".json")])
+            try:
+                stat = os.stat(meta_path)
+                size = stat.st_size + os.path.getsize(npy_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, size, npy_path, meta_path))
+
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, npy_path, meta_path in sorted(entries):
+            if total <= max_bytes:
+                break
+            # Metadata first, so the entry is gone before its features are
+            for path in [meta_path, npy_path]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def _atomic_write(self, path: str, write_fn, binary: bool) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb" if binary else "w") as f:
+                write_fn(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
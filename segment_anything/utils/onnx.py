@@ -8,12 +8,34 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
-from typing import Tuple
+import inspect
+from typing import Any, Dict, Tuple
 
 from ..modeling import Sam
 from .amg import calculate_stability_score
 
 
+class SamOnnxImageEncoder(nn.Module):
+    """
+    This model should not be called directly, but is used in ONNX export.
+    It combines Sam's preprocessing (normalization and padding) with the
+    image encoder. The input is an image already resized with
+    ResizeLongestSide, as an HxWx3 float array in RGB order, so the exported
+    graph only needs a resize in front of it.
+    """
+
+    def __init__(self, model: Sam) -> None:
+        super().__init__()
+        self.model = model
+        self.img_size = model.image_encoder.img_size
+
+    @torch.no_grad()
+    def forward(self, input_image: torch.Tensor) -> torch.Tensor:
+        x = input_image.permute(2, 0, 1)[None, :, :, :]
+        x = self.model.preprocess(x)
+        return self.model.image_encoder(x)
+
+
 class SamOnnxModel(nn.Module):
     """
     This model should not be called directly, but is used in ONNX export.
@@ -142,3 +164,76 @@ class SamOnnxModel(nn.Module):
             return upscaled_masks, scores, stability_scores, areas, masks
 
         return upscaled_masks, scores, masks
+
+
+def _export_kwargs() -> Dict[str, Any]:
+    # Newer torch defaults to the dynamo exporter, which does not support
+    # the dynamic_axes used below.
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        return {"dynamo": False}
+    return {}
+
+
+def export_image_encoder(model: Sam, output: str, opset: int = 17) -> None:
+    """
+    Exports Sam's preprocessing and image encoder to an ONNX file. The graph
+    takes 'input_image' (HxWx3 float, long side resized to the encoder's
+    img_size) and returns 'image_embeddings' (1xCxHxW).
+    """
+    onnx_model = SamOnnxImageEncoder(model)
+    h, w = model.image_encoder.img_size, model.image_encoder.img_size * 3 // 4
+    dummy_input = torch.randint(0, 255, (h, w, 3), dtype=torch.float)
+    torch.onnx.export(
+        onnx_model,
+        (dummy_input,),
+        output,
+        export_params=True,
+        verbose=False,
+        opset_version=opset,
+        do_constant_folding=True,
+        input_names=["input_image"],
+        output_names=["image_embeddings"],
+        dynamic_axes={"input_image": {0: "image_height", 1: "image_width"}},
+        **_export_kwargs(),
+    )
+
+
+def export_mask_decoder(
+    model: Sam,
+    output: str,
+    opset: int = 17,
+    return_single_mask: bool = False,
+) -> None:
+    """
+    Exports Sam's prompt encoder, mask decoder and mask postprocessing to an
+    ONNX file, using SamOnnxModel. With return_single_mask=False all mask
+    tokens are returned, and the caller selects the multimask outputs.
+    """
+    onnx_model = SamOnnxModel(model, return_single_mask=return_single_mask)
+    embed_dim = model.prompt_encoder.embed_dim
+    embed_size = model.prompt_encoder.image_embedding_size
+    mask_input_size = [4 * x for x in embed_size]
+    dummy_inputs = {
+        "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+        "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+        "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
+        "has_mask_input": torch.tensor([1], dtype=torch.float),
+        "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
+    }
+    torch.onnx.export(
+        onnx_model,
+        tuple(dummy_inputs.values()),
+        output,
+        export_params=True,
+        verbose=False,
+        opset_version=opset,
+        do_constant_folding=True,
+        input_names=list(dummy_inputs.keys()),
+        output_names=["masks", "iou_predictions", "low_res_masks"],
+        dynamic_axes={
+            "point_coords": {1: "num_points"},
+            "point_labels": {1: "num_points"},
+        },
+        **_export_kwargs(),
+    )
@@ -7,9 +7,7 @@
 import numpy as np
 import torch
 from torch.nn import functional as F
-from torchvision.transforms.functional import resize, to_pil_image  # type: ignore
 
-from copy import deepcopy
 from typing import Tuple
 
 
@@ -27,8 +25,19 @@ class ResizeLongestSide:
         """
         Expects a numpy array with shape HxWxC in uint8 format.
         """
+        return self.apply_image_to_torch(image)[0].permute(1, 2, 0).contiguous().numpy()
+
+    def apply_image_to_torch(self, image: np.ndarray) -> torch.Tensor:
+        """
+        Expects a numpy array with shape HxWxC in uint8 format, and returns
+        the resized image as a 1xCxHxW uint8 tensor. The input is read in
+        place, without a copy, and resized with torch's antialiased bilinear
+        kernel, which is within 1 of the PIL resize SAM was trained with.
+        """
         target_size = self.get_preprocess_shape(image.shape[0], image.shape[1], self.target_length)
-        return np.array(resize(to_pil_image(image), target_size))
+        # torch can't view arrays with negative strides, e.g. image[..., ::-1]
+        x = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)[None, :, :, :]
+        return F.interpolate(x, target_size, mode="bilinear", align_corners=False, antialias=True)
 
     def apply_coords(self, coords: np.ndarray, original_size: Tuple[int, ...]) -> np.ndarray:
         """
@@ -39,10 +48,7 @@ class ResizeLongestSide:
         new_h, new_w = self.get_preprocess_shape(
             original_size[0], original_size[1], self.target_length
         )
-        coords = deepcopy(coords).astype(float)
-        coords[..., 0] = coords[..., 0] * (new_w / old_w)
-        coords[..., 1] = coords[..., 1] * (new_h / old_h)
-        return coords
+        return coords.astype(float) * np.array([new_w / old_w, new_h / old_h])
 
     def apply_boxes(self, boxes: np.ndarray, original_size: Tuple[int, ...]) -> np.ndarray:
         """
@@ -75,10 +81,8 @@ class ResizeLongestSide:
         new_h, new_w = self.get_preprocess_shape(
             original_size[0], original_size[1], self.target_length
         )
-        coords = deepcopy(coords).to(torch.float)
-        coords[..., 0] = coords[..., 0] * (new_w / old_w)
-        coords[..., 1] = coords[..., 1] * (new_h / old_h)
-        return coords
+        scale = torch.tensor([new_w / old_w, new_h / old_h], device=coords.device)
+        return coords.to(torch.float) * scale
 
     def apply_boxes_torch(
         self, boxes: torch.Tensor, original_size: Tuple[int, ...]
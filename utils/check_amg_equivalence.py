@@ -0,0 +1,262 @@
+"""
+Checks the vectorized and bit-packed mask helpers in segment_anything.utils.amg
+against straightforward reference implementations, on random masks:
+RLE encoding and decoding, mask packing, MaskData concatenation and
+filtering against plain tensors, and the small-region cleanups of packed
+masks and of masks kept only within their box against remove_small_regions
+on the full mask. Also checks the generator's small-region postprocessing
+of geometry output against that of packed masks, on batches that may be
+empty.
+
+Usage: python -m utils.check_amg_equivalence [n_cases]
+"""
+import sys
+import cv2
+import numpy as np
+import torch
+
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.utils.amg import (
+    MaskData,
+    batched_mask_moments,
+    batched_mask_to_box,
+    mask_to_rle_pytorch,
+    pack_mask_rows,
+    pack_masks,
+    remove_small_regions,
+    remove_small_regions_in_box,
+    remove_small_regions_packed,
+    rle_to_mask,
+    unpack_mask,
+    unpack_mask_rows,
+    unpack_masks,
+)
+
+# ---- Reference implementations, as in the original segment_anything ----
+
+def reference_mask_to_rle(tensor):
+    b, h, w = tensor.shape
+    tensor = tensor.permute(0, 2, 1).flatten(1)
+    diff = tensor[:, 1:] ^ tensor[:, :-1]
+    change_indices = diff.nonzero()
+    out = []
+    for i in range(b):
+        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
+        cur_idxs = torch.cat([torch.tensor([0]), cur_idxs + 1, torch.tensor([h * w])])
+        counts = [] if tensor[i, 0] == 0 else [0]
+        counts.extend((cur_idxs[1:] - cur_idxs[:-1]).tolist())
+        out.append({"size": [h, w], "counts": counts})
+    return out
+
+def reference_rle_to_mask(rle):
+    h, w = rle["size"]
+    mask = np.empty(h * w, dtype=bool)
+    idx = 0
+    parity = False
+    for count in rle["counts"]:
+        mask[idx : idx + count] = parity
+        idx += count
+        parity ^= True
+    return mask.reshape(w, h).transpose()
+
+def reference_small_region_cleanup(mask, area_thresh):
+    mask, holes_changed = remove_small_regions(mask, area_thresh, mode="holes")
+    mask, islands_changed = remove_small_regions(mask, area_thresh, mode="islands")
+    return mask, holes_changed or islands_changed
+
+# ---- Random masks ----
+
+def random_masks(rng, b, h, w):
+    """Blobs with holes and specks, some touching the border, plus empty and full masks."""
+    masks = np.zeros((b, h, w), dtype=np.uint8)
+    for mask in masks:
+        for _ in range(rng.integers(1, 4)):
+            center = (int(rng.integers(-w // 4, w + w // 4)), int(rng.integers(-h // 4, h + h // 4)))
+            axes = (int(rng.integers(1, w + 1)), int(rng.integers(1, h + 1)))
+            cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, 1, -1)
+        specks = rng.random((h, w)) < rng.uniform(0, 0.02)
+        mask[specks] ^= 1
+    if b > 2:
+        masks[0] = 0
+        masks[1] = 1
+    return torch.as_tensor(masks.astype(bool))
+
+# ---- Checks ----
+
+def check_rle(rng, n_cases):
+    for _ in range(n_cases):
+        masks = random_masks(rng, int(rng.integers(1, 6)), int(rng.integers(1, 40)), int(rng.integers(1, 40)))
+        rles = mask_to_rle_pytorch(masks)
+        if rles != reference_mask_to_rle(masks):
+            return False
+        for rle, mask in zip(rles, masks.numpy()):
+            if not np.array_equal(rle_to_mask(rle), mask) or not np.array_equal(reference_rle_to_mask(rle), mask):
+                return False
+    return True
+
+def check_packing(rng, n_cases):
+    for _ in range(n_cases):
+        h, w = int(rng.integers(1, 40)), int(rng.integers(1, 40))
+        masks = random_masks(rng, int(rng.integers(0, 5)), h, w)
+        packed = pack_masks(masks)
+        expected = np.stack([np.packbits(m) for m in masks.numpy()]) if len(masks) else packed.numpy()
+        if not np.array_equal(packed.numpy(), expected):
+            return False
+        if not torch.equal(unpack_masks(packed, (h, w)), masks):
+            return False
+        for mask, row in zip(masks.numpy(), packed.numpy()):
+            if not np.array_equal(unpack_mask(row, (h, w)), mask):
+                return False
+            y0 = int(rng.integers(0, h))
+            y1 = int(rng.integers(y0, h + 1))
+            if not np.array_equal(unpack_mask_rows(row, (h, w), y0, y1), mask[y0:y1]):
+                return False
+            new_rows = rng.random((y1 - y0, w)) < 0.5
+            row = row.copy()
+            pack_mask_rows(row, (h, w), y0, new_rows)
+            expected_mask = mask.copy()
+            expected_mask[y0:y1] = new_rows
+            if not np.array_equal(row, np.packbits(expected_mask)):
+                return False
+    return True
+
+def check_mask_data(rng, n_cases):
+    for _ in range(n_cases):
+        h, w = int(rng.integers(1, 20)), int(rng.integers(1, 20))
+        batches = [random_masks(rng, int(rng.integers(0, 6)), h, w) for _ in range(rng.integers(1, 6))]
+        items = [
+            MaskData(
+                packed_masks=pack_masks(masks),
+                areas=masks.flatten(1).sum(1),
+                rles=mask_to_rle_pytorch(masks),
+                mask_size=(h, w),
+            )
+            for masks in batches
+        ]
+        data = MaskData(mask_size=(h, w))
+        for item in items:
+            data.cat(item)
+        masks = torch.cat(batches)
+        keep = torch.as_tensor(rng.random(len(masks)) < 0.5)
+        masks = masks[keep]
+        for data in [data, MaskData.concat(items)]:
+            data.filter(keep)
+            data.to_numpy()
+            if len(data["areas"]) != len(masks) or data["rles"] != mask_to_rle_pytorch(masks):
+                return False
+            if not np.array_equal(data["areas"], masks.flatten(1).sum(1).numpy()):
+                return False
+            if not all(np.array_equal(data.get_mask(i), mask) for i, mask in enumerate(masks.numpy())):
+                return False
+    return True
+
+def check_small_region_cleanup(rng, n_cases):
+    for _ in range(n_cases):
+        h, w = int(rng.integers(2, 80)), int(rng.integers(2, 80))
+        mask = random_masks(rng, 1, h, w)
+        if not mask.any():
+            continue
+        area_thresh = float(rng.integers(1, 200))
+        packed = pack_masks(mask)[0].numpy()
+        box = batched_mask_to_box(mask)[0].tolist()
+        result = remove_small_regions_packed(packed, (h, w), box, area_thresh)
+
+        expected, changed = reference_small_region_cleanup(mask[0].numpy(), area_thresh)
+        if (result is not None) != changed or not np.array_equal(unpack_mask(packed, (h, w)), expected):
+            return False
+        if result is not None:
+            crop, (x0, y0, x1, y1) = result
+            if not np.array_equal(crop, expected[y0:y1, x0:x1]):
+                return False
+    return True
+
+def check_small_region_cleanup_in_box(rng, n_cases):
+    for _ in range(n_cases):
+        h, w = int(rng.integers(2, 80)), int(rng.integers(2, 80))
+        mask = random_masks(rng, 1, h, w)
+        area_thresh = float(rng.integers(1, 200))
+        x0, y0, x1, y1 = box = batched_mask_to_box(mask)[0].tolist()
+        mask = mask[0].numpy()
+        result = remove_small_regions_in_box(mask[y0 : y1 + 1, x0 : x1 + 1], box, (h, w), area_thresh)
+
+        expected, changed = reference_small_region_cleanup(mask, area_thresh)
+        if (result is not None) != changed:
+            return False
+        if result is not None:
+            # The cleaned mask is empty outside of the returned region
+            crop, (cx0, cy0, cx1, cy1) = result
+            cleaned = np.zeros((h, w), dtype=bool)
+            cleaned[cy0:cy1, cx0:cx1] = crop
+            if not np.array_equal(cleaned, expected):
+                return False
+    return True
+
+def geometry_and_packed_data(masks):
+    """MaskData for a batch of masks, as the generator keeps them for geometry and mask output."""
+    boxes = batched_mask_to_box(masks)
+    areas, centroids, central_moments = batched_mask_moments(masks)
+    box_masks = [
+        np.packbits(mask[y0 : y1 + 1, x0 : x1 + 1])
+        for mask, (x0, y0, x1, y1) in zip(masks.numpy(), boxes.tolist())
+    ]
+    iou_preds = torch.rand(len(masks))
+    mask_size = tuple(masks.shape[-2:])
+    geometry = MaskData(
+        boxes=boxes,
+        iou_preds=iou_preds,
+        areas=areas,
+        centroids=centroids,
+        central_moments=central_moments,
+        box_masks=box_masks,
+        mask_size=mask_size,
+    )
+    packed = MaskData(
+        boxes=boxes.clone(),
+        iou_preds=iou_preds,
+        areas=areas.clone(),
+        packed_masks=pack_masks(masks),
+        mask_size=mask_size,
+    )
+    return geometry, packed
+
+def check_postprocess_small_regions(rng, n_cases):
+    for _ in range(n_cases):
+        h, w = int(rng.integers(2, 60)), int(rng.integers(2, 60))
+        # Batches that lost all their masks to the filters come out empty
+        batches = [random_masks(rng, int(rng.integers(0, 4)), h, w) for _ in range(rng.integers(1, 4))]
+        geometry, packed = (MaskData.concat(items) for items in zip(*map(geometry_and_packed_data, batches)))
+        if len(geometry["iou_preds"]) == 0:
+            continue
+        area_thresh = float(rng.integers(1, 200))
+        for data in [geometry, packed]:
+            SamAutomaticMaskGenerator.postprocess_small_regions(data, area_thresh, 0.7, num_workers=1)
+        if not torch.equal(geometry["boxes"], packed["boxes"]) or not torch.equal(geometry["areas"], packed["areas"]):
+            return False
+        masks = torch.as_tensor(np.stack([packed.get_mask(i) for i in range(len(packed["iou_preds"]))]))
+        _, centroids, central_moments = batched_mask_moments(masks)
+        if not torch.allclose(geometry["centroids"], centroids) or not torch.allclose(
+            geometry["central_moments"], central_moments, rtol=1e-4, atol=1e-2
+        ):
+            return False
+    return True
+
+def check_amg_equivalence(n_cases=3000):
+    rng = np.random.default_rng(0)
+    checks = [
+        ("rle", check_rle, n_cases // 10),
+        ("packing", check_packing, n_cases // 10),
+        ("mask_data", check_mask_data, n_cases // 10),
+        ("small_region_cleanup", check_small_region_cleanup, n_cases),
+        ("small_region_cleanup_in_box", check_small_region_cleanup_in_box, n_cases),
+        ("postprocess_small_regions", check_postprocess_small_regions, n_cases // 10),
+    ]
+    results = []
+    for name, check, n in checks:
+        ok = check(rng, n)
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: {n} random cases")
+        results.append(ok)
+    return all(results)
+
+if __name__ == "__main__":
+    n_cases = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    sys.exit(0 if check_amg_equivalence(n_cases) else 1)
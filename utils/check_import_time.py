@@ -0,0 +1,52 @@
+"""
+Checks that the modules app.py imports stay cheap to import: none of them
+may pull in the heavy model libraries, and together they must import within
+the budget, so the Streamlit page paints before the models are ready.
+
+Usage: python -m utils.check_import_time [budget_seconds]
+"""
+import subprocess
+import sys
+
+IMPORT_BUDGET_SECONDS = 1.0
+
+APP_MODULES = [
+    "utils.pdf_generator",
+    "utils.logo_fetcher",
+    "utils.image_overlay",
+    "utils.product_inspector_sam",
+    "utils.model_registry",
+]
+
+HEAVY_MODULES = ["torch", "torchvision", "rembg", "onnxruntime", "openai", "gdown"]
+
+# Runs in a fresh interpreter so nothing is already imported. Streamlit is
+# imported before the clock starts: the app pays for it regardless.
+_PROBE = """
+import importlib, sys, time
+try:
+    import streamlit
+except ImportError:
+    pass
+start = time.perf_counter()
+for name in {modules!r}:
+    importlib.import_module(name)
+print(time.perf_counter() - start)
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+def check_import_time(budget=IMPORT_BUDGET_SECONDS):
+    probe = _PROBE.format(modules=APP_MODULES, heavy=HEAVY_MODULES)
+    out = subprocess.run(
+        [sys.executable, "-c", probe], capture_output=True, text=True, check=True
+    ).stdout.splitlines()
+    elapsed, heavy = float(out[0]), [m for m in out[1].split(",") if m]
+
+    ok = elapsed <= budget and not heavy
+    print(f"{'OK  ' if ok else 'FAIL'} imported app modules in {elapsed:.2f}s "
+          f"(budget {budget:.2f}s), heavy modules imported: {heavy or 'none'}")
+    return ok
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else IMPORT_BUDGET_SECONDS
+    sys.exit(0 if check_import_time(budget) else 1)
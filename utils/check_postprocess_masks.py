@@ -0,0 +1,54 @@
+"""
+Checks Sam.postprocess_masks_fused over a sweep of image sizes: the masks
+must come out at exactly the original image size, and resizing only within
+each mask's box (crop_to_box=True) must give the same thresholded masks as
+the full resize, up to logits within rounding error of the threshold.
+
+Usage: python -m utils.check_postprocess_masks [n_sizes]
+"""
+import sys
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from segment_anything import sam_model_registry
+from segment_anything.utils.transforms import ResizeLongestSide
+
+# Sizes that came out a pixel short when the output size was left to
+# F.interpolate
+KNOWN_SIZES = [(411, 566), (3001, 2005)]
+
+# Both resizes sample the same positions, but round differently
+THRESHOLD_TOLERANCE = 1e-4
+
+def random_low_res_masks(rng, n, size):
+    """Smooth random logits, so the thresholded masks are blobs."""
+    coarse = torch.as_tensor(rng.standard_normal((n, 1, 8, 8)), dtype=torch.float32)
+    return F.interpolate(coarse, (size, size), mode="bilinear", align_corners=False) * 10
+
+def check_postprocess_masks(n_sizes=200):
+    sam = sam_model_registry["vit_b"]()
+    img_size = sam.image_encoder.img_size
+    rng = np.random.default_rng(0)
+    sizes = KNOWN_SIZES + [tuple(int(v) for v in rng.integers(16, 4000, 2)) for _ in range(n_sizes)]
+    low_res = random_low_res_masks(rng, 3, img_size // 4)
+    results = []
+    with torch.no_grad():
+        for original_size in sizes:
+            input_size = ResizeLongestSide.get_preprocess_shape(*original_size, img_size)
+            full = sam.postprocess_masks_fused(low_res, input_size, original_size)
+            cropped = sam.postprocess_masks_fused(low_res, input_size, original_size, crop_to_box=True)
+            ok = tuple(full.shape[-2:]) == original_size and tuple(cropped.shape[-2:]) == original_size
+            if ok:
+                clear = (full - sam.mask_threshold).abs() > THRESHOLD_TOLERANCE
+                disagree = (full > sam.mask_threshold) != (cropped > sam.mask_threshold)
+                ok = not bool((disagree & clear).any())
+            if not ok:
+                print(f"FAIL {original_size}: got {tuple(full.shape[-2:])} and {tuple(cropped.shape[-2:])}")
+            results.append(ok)
+    print(f"{'OK  ' if all(results) else 'FAIL'} postprocess_masks_fused: {len(sizes)} image sizes")
+    return all(results)
+
+if __name__ == "__main__":
+    n_sizes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    sys.exit(0 if check_postprocess_masks(n_sizes) else 1)
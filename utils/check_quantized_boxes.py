@@ -0,0 +1,50 @@
+"""
+Compares the print-area boxes found with the fp32 vit_b model against the
+int8 quantized vit_b_int8 model on the shipped products.
+
+Usage: python -m utils.check_quantized_boxes [product_dir]
+"""
+import os
+import sys
+import cv2
+
+from segment_anything import sam_model_registry, SamPredictor
+from utils.product_inspector_sam import build_mask_generator, ensure_sam_checkpoint, find_box_and_angle
+
+MIN_BOX_IOU = 0.9
+MAX_ANGLE_DIFF = 2.0  # Logos are only rotated for angles above 2 degrees
+
+def box_iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 1.0
+
+def compare_quantized_boxes(product_dir="assets/products", mode="prompt"):
+    models = {
+        model_type: sam_model_registry[model_type](checkpoint=ensure_sam_checkpoint())
+        for model_type in ["vit_b", "vit_b_int8"]
+    }
+    results = []
+    for fname in sorted(os.listdir(product_dir)):
+        if not fname.lower().endswith((".png", ".jpg", ".jpeg")):
+            continue
+        image = cv2.imread(os.path.join(product_dir, fname))
+        if image is None:
+            continue
+        fp32, int8 = [
+            find_box_and_angle(image, SamPredictor(model), build_mask_generator(model), mode=mode)
+            for model in models.values()
+        ]
+        iou = box_iou(fp32["box"], int8["box"])
+        angle_diff = abs(fp32["angle"] - int8["angle"])
+        ok = iou >= MIN_BOX_IOU and angle_diff <= MAX_ANGLE_DIFF
+        print(f"{'OK  ' if ok else 'FAIL'} {fname}: fp32={fp32['box']} int8={int8['box']} "
+              f"iou={iou:.3f} angle_diff={angle_diff:.2f}")
+        results.append(ok)
+    return all(results)
+
+if __name__ == "__main__":
+    product_dir = sys.argv[1] if len(sys.argv) > 1 else "assets/products"
+    sys.exit(0 if compare_quantized_boxes(product_dir) else 1)
@@ -1,17 +1,26 @@
-import os
 import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse, urljoin
 from PIL import Image, ImageOps, ImageFilter
 from io import BytesIO
-from rembg import remove
-from openai import OpenAI
 from dotenv import load_dotenv
 
+from utils import model_registry
+
 load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
 
-client = OpenAI(api_key=api_key)
+def _create_rembg_session():
+    from rembg import new_session
+
+    return new_session()
+
+def _warm_up_rembg(session):
+    from rembg import remove
+
+    remove(Image.new("RGBA", (32, 32), (255, 255, 255, 255)), session=session)
+
+# Created on first use; see model_registry
+model_registry.register("rembg_session", _create_rembg_session, warm_up=_warm_up_rembg)
 
 def resolve_company_to_domain_gpt(user_input):
     """
@@ -33,6 +42,7 @@ def resolve_company_to_domain_gpt(user_input):
         "Domain:"
     )
 
+    client = model_registry.get("openai_client")
     resp = client.chat.completions.create(
         model="gpt-3.5-turbo",
         messages=[
@@ -128,8 +138,10 @@ def add_outline(image, outline_width=2, outline_color=(50, 50, 50, 255)):
 
 def save_logo(content, output_path="output/logo_raw.png"):
     try:
+        from rembg import remove
+
         img = Image.open(BytesIO(content)).convert("RGBA")
-        img_nobg = remove(img)
+        img_nobg = remove(img, session=model_registry.get("rembg_session"))
         img_with_outline = add_outline(img_nobg)
         img_with_outline.save(output_path)
         print(f"Logo saved to {output_path} (bg removed, outline added)")
@@ -1,14 +1,11 @@
-import os
 import json
 import re
 from dotenv import load_dotenv
-from openai import OpenAI
 import streamlit as st
 
-load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
+from utils import model_registry
 
-client = OpenAI(api_key=api_key)
+load_dotenv()
 
 def get_logo_scale_percentages(product_name, image_size, box_coords, logo_size):
     image_width, image_height = image_size
@@ -41,6 +38,7 @@ Output only valid JSON with the following format:
 }}
 """
 
+    client = model_registry.get("openai_client")
     response = client.chat.completions.create(
         model="gpt-3.5-turbo",
         messages=[
@@ -0,0 +1,81 @@
+"""
+Process-wide registry for heavy resources (SAM, rembg, OpenAI clients).
+
+Modules register a factory at import time, which is cheap; the resource is
+only created on first get(), once per process, even when several Streamlit
+session threads ask for it at the same time.
+"""
+import os
+import threading
+import traceback
+
+_factories = {}
+_instances = {}
+_locks = {}
+_warm_ups = []
+_registry_lock = threading.Lock()
+_warm_up_thread = None
+
+def register(name, factory, warm_up=None):
+    """
+    Registers factory() as the way to create resource `name`. warm_up, if
+    given, is called by start_warm_up with the created resource, and should
+    run one cheap dummy inference.
+    """
+    with _registry_lock:
+        _factories[name] = factory
+        _locks.setdefault(name, threading.Lock())
+        if warm_up is not None:
+            _warm_ups.append((name, warm_up))
+
+def get(name):
+    """Returns resource `name`, creating it on first use."""
+    instance = _instances.get(name)
+    if instance is not None:
+        return instance
+
+    with _registry_lock:
+        if name not in _factories:
+            raise KeyError(f"No resource registered as '{name}'")
+        lock = _locks[name]
+    with lock:
+        if name not in _instances:
+            _instances[name] = _factories[name]()
+    return _instances[name]
+
+def is_ready(name):
+    return name in _instances
+
+def _run_warm_ups():
+    with _registry_lock:
+        warm_ups = list(_warm_ups)
+    for name, warm_up in warm_ups:
+        try:
+            warm_up(get(name))
+            print(f"[WARMUP] {name} ready.")
+        except Exception:
+            print(f"[WARMUP] {name} failed:")
+            traceback.print_exc()
+
+def start_warm_up():
+    """
+    Creates every resource with a registered warm-up and runs its dummy
+    inference on a daemon thread. Only the first call per process starts
+    the thread; later calls return the same thread.
+    """
+    global _warm_up_thread
+    with _registry_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=_run_warm_ups, name="model-warm-up", daemon=True)
+            _warm_up_thread.start()
+        return _warm_up_thread
+
+def _create_openai_client():
+    from dotenv import load_dotenv
+    from openai import OpenAI
+
+    load_dotenv()
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Shared by logo_fetcher and logo_size_gpt
+register("openai_client", _create_openai_client)
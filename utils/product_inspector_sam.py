@@ -1,35 +1,114 @@
 import os
-import pickle
+from multiprocessing import AuthenticationError
 import cv2
 import numpy as np
-import torch
-import gdown 
 
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
+from utils import model_registry, sam_cache, sam_server
+
+# SAM, torch and gdown are only imported when the model is first needed (see
+# model_registry), so importing this module does not block the UI. With
+# SAM_SERVER_ADDRESS set, they are never imported here: requests go to the
+# shared server instead (see sam_server).
 
 # Path to model
 sam_checkpoint = "models/sam_vit_b_01ec64.pth"
 
-# Auto-download from Google Drive if not present
-if not os.path.exists(sam_checkpoint):
-    os.makedirs("models", exist_ok=True)
-    file_id = "1KwMOXdhOUb4zyiew1S2lIkQ6Jw6MNb5u"
-    url = f"https://drive.google.com/uc?id={file_id}"
-    print("Downloading SAM model from Google Drive...")
-    gdown.download(url, sam_checkpoint, quiet=False)
-
-# Load SAM model
-sam = sam_model_registry["vit_b"](checkpoint=sam_checkpoint)
-sam.to("cpu")
-
-# Initialize mask generator
-mask_generator = SamAutomaticMaskGenerator(
-    model=sam,
-    points_per_side=16,
-    pred_iou_thresh=0.88,
-    stability_score_thresh=0.95,
-    min_mask_region_area=1000,
-)
+# "vit_b" or "vit_b_int8"; both load the same fp32 checkpoint
+SAM_MODEL_TYPE = os.getenv("SAM_MODEL_TYPE", "vit_b")
+
+# Mask quality thresholds, shared by the prompted path and the AMG fallback
+PRED_IOU_THRESH = 0.88
+STABILITY_SCORE_THRESH = 0.95
+MAX_BOX_AREA_RATIO = 0.6
+
+# Images per batched encoder pass; the global-attention blocks of vit_b need
+# roughly 1 GB per image at this size.
+EMBED_BATCH_SIZE = 4
+
+def ensure_sam_checkpoint():
+    # Auto-download from Google Drive if not present
+    if not os.path.exists(sam_checkpoint):
+        import gdown
+
+        os.makedirs("models", exist_ok=True)
+        file_id = "1KwMOXdhOUb4zyiew1S2lIkQ6Jw6MNb5u"
+        url = f"https://drive.google.com/uc?id={file_id}"
+        print("Downloading SAM model from Google Drive...")
+        gdown.download(url, sam_checkpoint, quiet=False)
+    return sam_checkpoint
+
+AMG_POINTS_PER_SIDE = 16
+AMG_MIN_MASK_REGION_AREA = 1000
+# Point prompts placed on the product instead of a 16x16 grid over the whole
+# photo, which is mostly background
+AMG_POINTS_BUDGET = 64
+# AMG fallback: the largest of the first few usable masks covering at least
+# this fraction of the foreground; smaller ones are parts like labels or caps
+AMG_MIN_FOREGROUND_FRACTION = 0.2
+AMG_TOP_K = 3
+# Bytes the upscaled masks of one AMG batch may use; with low_res_filtering
+# this only sets how many are upscaled at once, not the result
+AMG_MEMORY_BUDGET = int(os.getenv("SAM_AMG_MEMORY_BUDGET", 1024 * 1024 * 1024))
+# Size budget of the image embedding store; a vit_b embedding is about 2 MB
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("SAM_EMBEDDING_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+def build_mask_generator(model):
+    from segment_anything import SamAutomaticMaskGenerator
+
+    return SamAutomaticMaskGenerator(
+        model=model,
+        points_per_side=AMG_POINTS_PER_SIDE,
+        pred_iou_thresh=PRED_IOU_THRESH,
+        stability_score_thresh=STABILITY_SCORE_THRESH,
+        min_mask_region_area=AMG_MIN_MASK_REGION_AREA,
+        # Product photos are large; only upscale masks that pass the filters
+        low_res_filtering=True,
+        # Only boxes and moments are used, see box_and_angle_from_record
+        output_mode="geometry",
+        point_sampling="foreground",
+        points_budget=AMG_POINTS_BUDGET,
+        memory_budget=AMG_MEMORY_BUDGET,
+    )
+
+def _load_sam():
+    from segment_anything import sam_model_registry
+
+    sam = sam_model_registry[SAM_MODEL_TYPE](checkpoint=ensure_sam_checkpoint())
+    sam.to("cpu")
+    return sam
+
+def _load_predictor():
+    # Prompted predictor: one encoder pass plus a handful of decoder calls.
+    # Image embeddings persist across restarts, keyed by image content.
+    from segment_anything import SamPredictor
+    from segment_anything.utils.embedding_store import EmbeddingStore
+
+    embedding_store = EmbeddingStore(
+        "cache/embeddings", model_type=SAM_MODEL_TYPE, max_bytes=EMBEDDING_CACHE_MAX_BYTES
+    )
+    return SamPredictor(model_registry.get("sam"), embedding_store=embedding_store)
+
+def warm_up_sam(sam):
+    # One encoder pass and one decoder call on a dummy product shot. Uses its
+    # own predictor so nothing is written to the embedding store.
+    from segment_anything import SamPredictor
+
+    image = np.full((256, 256, 3), 255, dtype=np.uint8)
+    image[64:192, 96:160] = 80
+    warm_up_predictor = SamPredictor(sam)
+    warm_up_predictor.set_image(image)
+    warm_up_predictor.predict(point_coords=np.array([[128, 128]]), point_labels=np.array([1]))
+
+# Workers using the server must not load their own model to warm it up
+model_registry.register("sam", _load_sam, warm_up=None if sam_server.SERVER_ADDRESS else warm_up_sam)
+model_registry.register("sam_predictor", _load_predictor)
+model_registry.register("sam_mask_generator", lambda: build_mask_generator(model_registry.get("sam")))
+
+def get_predictor():
+    return model_registry.get("sam_predictor")
+
+def get_mask_generator():
+    return model_registry.get("sam_mask_generator")
 
 def clamp_box_within(image_shape, box, max_ratio=0.35):
     height, width = image_shape[:2]
@@ -45,60 +124,247 @@ def clamp_box_within(image_shape, box, max_ratio=0.35):
     y2 = min(height, y1 + box_h)
     return (x1, y1, x2, y2)
 
-def get_sam_cache_path(image_path):
-    cache_dir = "cache/sam"
-    os.makedirs(cache_dir, exist_ok=True)
-    fname = os.path.splitext(os.path.basename(image_path))[0]
-    return os.path.join(cache_dir, f"{fname}.pkl")
-
-def get_sam_bounding_box_and_angle(image_path):
-    cache_path = get_sam_cache_path(image_path)
-    if os.path.exists(cache_path):
-        with open(cache_path, "rb") as f:
-            result = pickle.load(f)
-            return result['box'], result['angle']
-    
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError(f"Could not load image at {image_path}")
+def get_sam_cache_key(image_path, mode="prompt"):
+    # Everything that changes the result goes into the key, next to the image bytes
+    params = {
+        "model_type": SAM_MODEL_TYPE,
+        "mode": mode,
+        "pred_iou_thresh": PRED_IOU_THRESH,
+        "stability_score_thresh": STABILITY_SCORE_THRESH,
+        "max_box_area_ratio": MAX_BOX_AREA_RATIO,
+        "points_per_side": AMG_POINTS_PER_SIDE,
+        "min_mask_region_area": AMG_MIN_MASK_REGION_AREA,
+        "low_res_filtering": True,
+        "amg_min_foreground_fraction": AMG_MIN_FOREGROUND_FRACTION,
+        "amg_top_k": AMG_TOP_K,
+        # The generator used to be given the BGR image as RGB
+        "amg_image_format": "RGB",
+        "amg_output_mode": "geometry",
+        "amg_points_budget": AMG_POINTS_BUDGET,
+        "prompt_postprocess": "fused",
+        "prompt_foreground": "estimate_foreground",
+    }
+    return sam_cache.cache_key(image_path, params)
+
+def get_foreground_box_and_centroid(image):
+    """
+    Box and centroid of the largest foreground region, using the same
+    foreground estimate as the mask generator's point sampling.
+    """
+    from segment_anything.utils.amg import estimate_foreground
+
+    foreground = estimate_foreground(image).astype(np.uint8)
+    n_labels, _, stats, centroids = cv2.connectedComponentsWithStats(foreground, connectivity=8)
+    if n_labels < 2:
+        return None, None
+
+    largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])  # Label 0 is the background
+    x, y, w, h = stats[largest, :4]
+    return (int(x), int(y), int(x + w), int(y + h)), tuple(float(v) for v in centroids[largest])
+
+def box_and_angle_from_geometry(rect, moments, image_shape):
+    """
+    Returns (box, angle) for a mask's bounding rect (x, y, w, h) and central
+    moments (mu20, mu11, mu02), or None if it covers too much of the image.
+    """
+    height, width = image_shape[:2]
+    x, y, w, h = rect
+    area = w * h
+    if area == 0 or area > height * width * MAX_BOX_AREA_RATIO:
+        return None
+
+    # Orientation by moments
+    angle = 0.0
+    if abs(moments["mu20"] - moments["mu02"]) > 1e-2:
+        angle = 0.5 * np.arctan2(2 * moments["mu11"], moments["mu20"] - moments["mu02"])
+        angle = np.degrees(angle) + 90
 
-    masks = mask_generator.generate(image)
-    masks = sorted(masks, key=lambda x: x['area'], reverse=True)
+    box = (x, y, x + w, y + h)
+    box = clamp_box_within(image_shape, box)
+    return box, angle
+
+def box_and_angle_from_mask(seg, image_shape):
+    """Returns (box, angle) for a uint8 mask, or None if it covers too much of the image."""
+    return box_and_angle_from_geometry(cv2.boundingRect(seg), cv2.moments(seg, binaryImage=True), image_shape)
+
+def box_and_angle_from_record(record, image_shape):
+    """Same as box_and_angle_from_mask, for a record from a geometry-mode mask generator."""
+    if record["area"] == 0:
+        return None
+    # AMG boxes use inclusive right/bottom edges, cv2.boundingRect exclusive ones
+    x, y, w, h = (int(v) for v in record["bbox"])
+    return box_and_angle_from_geometry((x, y, w + 1, h + 1), record["central_moments"], image_shape)
+
+def get_prompted_masks(image, sam_predictor, embedding=None):
+    """
+    Runs SamPredictor once on the RGB image, unless its embedding is given,
+    and decodes a few prompts (foreground box, image center, foreground
+    centroid). Returns the masks that pass the same IoU/stability thresholds
+    as the automatic generator, largest first.
+    """
     height, width = image.shape[:2]
-    img_area = height * width
+    fg_box, fg_centroid = get_foreground_box_and_centroid(image)
 
-    for mask in masks:
-        seg = mask['segmentation'].astype(np.uint8) * 255
-        x, y, w, h = cv2.boundingRect(seg)
-        area = w * h
-        if area > img_area * 0.6:
-            continue
+    prompts = []
+    if fg_box is not None:
+        prompts.append({"box": np.array(fg_box), "multimask_output": False})
+    prompts.append({"point_coords": np.array([[width / 2, height / 2]]), "point_labels": np.array([1])})
+    if fg_centroid is not None:
+        prompts.append({"point_coords": np.array([fg_centroid]), "point_labels": np.array([1])})
+
+    # The embedding is a handle, not predictor state, so the shared predictor
+    # can serve several requests at once
+    if embedding is None:
+        embedding = sam_predictor.encode(image)
+    mask_threshold = sam_predictor.model.mask_threshold
+    candidates = []
+    for prompt in prompts:
+        logits, iou_preds, _ = sam_predictor.predict_with_embedding(
+            embedding, return_logits=True, postprocess="fused", **prompt
+        )
+        # Same stability score as segment_anything.utils.amg.calculate_stability_score
+        intersections = (logits > mask_threshold + 1.0).sum(axis=(-2, -1))
+        unions = (logits > mask_threshold - 1.0).sum(axis=(-2, -1))
+        stability = intersections / np.maximum(unions, 1)
+        for mask_logits, iou_pred, score in zip(logits, iou_preds, stability):
+            if iou_pred < PRED_IOU_THRESH or score < STABILITY_SCORE_THRESH:
+                continue
+            candidates.append(mask_logits > mask_threshold)
+
+    return sorted(candidates, key=lambda seg: seg.sum(), reverse=True)
+
+def get_prompted_candidates(image, sam_predictor, embedding=None):
+    for mask in get_prompted_masks(image, sam_predictor, embedding):
+        seg = mask.astype(np.uint8) * 255
+        yield box_and_angle_from_mask(seg, image.shape), seg
+
+def get_amg_candidates(image, sam_mask_generator, embedding=None):
+    """
+    Yields candidates largest first, from the first AMG_TOP_K usable masks
+    that cover at least AMG_MIN_FOREGROUND_FRACTION of the foreground of the
+    RGB image. The generator stops once it has found them, instead of
+    running the whole point grid. It only returns mask geometry, so there
+    is no mask to keep. embedding, if given, is the image's embedding.
+    """
+    from segment_anything.utils.amg import estimate_foreground
+
+    min_area = AMG_MIN_FOREGROUND_FRACTION * estimate_foreground(image).sum()
+
+    def usable(record):
+        return record["area"] >= min_area and box_and_angle_from_record(record, image.shape) is not None
+
+    records = sam_mask_generator.generate_iter(
+        image, predicate=usable, max_masks=AMG_TOP_K, embedding=embedding
+    )
+    for record in sorted(records, key=lambda r: r["area"], reverse=True):
+        yield box_and_angle_from_record(record, image.shape), None
+
+def find_box_and_angle(image, sam_predictor, sam_mask_generator, mode="prompt", embedding=None):
+    """
+    Returns the uncached result dict (box, angle, mask) for a BGR image.
+    embedding, if given, is the image's embedding from sam_predictor.
+    """
+    # Both paths share one RGB image and one encoder pass; sam_predictor
+    # may find the embedding in its store
+    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if embedding is None:
+        embedding = sam_predictor.encode(image_rgb)
+
+    candidate_sources = [lambda im: get_amg_candidates(im, sam_mask_generator, embedding)]
+    if mode == "prompt":
+        candidate_sources.insert(0, lambda im: get_prompted_candidates(im, sam_predictor, embedding))
 
-        # Orientation by moments
-        moments = cv2.moments(seg)
-        angle = 0.0
-        if abs(moments["mu20"] - moments["mu02"]) > 1e-2:
-            angle = 0.5 * np.arctan2(2 * moments["mu11"], moments["mu20"] - moments["mu02"])
-            angle = np.degrees(angle) + 90
+    for get_candidates in candidate_sources:
+        for box_and_angle, seg in get_candidates(image_rgb):
+            if box_and_angle is None:
+                continue
 
-        box = (x, y, x + w, y + h)
-        box = clamp_box_within(image.shape, box)
-        result = {"box": box, "angle": angle, "mask": seg}
-        with open(cache_path, "wb") as f:
-            pickle.dump(result, f)
-        return box, angle
+            box, angle = box_and_angle
+            return {"box": box, "angle": angle, "mask": seg}
 
+    height, width = image.shape[:2]
     box_size = int(min(width, height) * 0.3)
     x1 = (width - box_size) // 2
     y1 = (height - box_size) // 2
-    fallback = {"box": (x1, y1, x1 + box_size, y1 + box_size), "angle": 0.0, "mask": None}
-    with open(cache_path, "wb") as f:
-        pickle.dump(fallback, f)
-    return fallback["box"], fallback["angle"]
+    return {"box": (x1, y1, x1 + box_size, y1 + box_size), "angle": 0.0, "mask": None}
+
+def get_sam_bounding_box_and_angle(image_path, mode="prompt"):
+    """
+    mode="prompt" decodes a few prompts on a single image embedding and only
+    falls back to the automatic mask generator if none of them is usable.
+    mode="amg" always runs the automatic mask generator.
+
+    Cache misses go to the SAM server if SAM_SERVER_ADDRESS is set, and are
+    computed in-process if it is not, or if the server can't be reached.
+    """
+    assert mode in ["prompt", "amg"], f"Unknown mode {mode}."
+    result = sam_cache.load(get_sam_cache_key(image_path, mode=mode))
+    if result is not None:
+        return result['box'], result['angle']
+
+    if sam_server.SERVER_ADDRESS:
+        try:
+            return sam_server.request("box_and_angle", os.path.abspath(image_path), mode)
+        except (OSError, EOFError, AuthenticationError) as e:
+            print(f"[SAM] Server unavailable, running SAM in-process: {e}")
+    return compute_sam_bounding_box_and_angle(image_path, mode=mode)
+
+def compute_sam_bounding_box_and_angle(image_path, mode="prompt", embedding=None):
+    """
+    In-process get_sam_bounding_box_and_angle. embedding, if given, is the
+    image's embedding from the shared predictor.
+    """
+    cache_key = get_sam_cache_key(image_path, mode=mode)
+    result = sam_cache.load(cache_key)
+    if result is not None:
+        return result['box'], result['angle']
+
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Could not load image at {image_path}")
+
+    result = find_box_and_angle(
+        image, get_predictor(), get_mask_generator(), mode=mode, embedding=embedding
+    )
+    sam_cache.save(cache_key, result)
+    return result["box"], result["angle"]
+
+def embed_product_images(image_paths):
+    """
+    Encodes every image without a cached SAM result in one batched encoder
+    pass, on the SAM server if one is configured. The embeddings land in the
+    embedding store, so the per-product calls that follow skip the encoder.
+    """
+    if sam_server.SERVER_ADDRESS:
+        try:
+            sam_server.request("embed", [os.path.abspath(p) for p in image_paths])
+            return
+        except (OSError, EOFError, AuthenticationError) as e:
+            print(f"[SAM] Server unavailable, running SAM in-process: {e}")
+    encode_product_images(image_paths)
+
+def encode_product_images(image_paths):
+    """
+    In-process embed_product_images. Returns a dict from image path to
+    ImageEmbedding, for the images that were encoded.
+    """
+    paths, images = [], []
+    for image_path in image_paths:
+        if sam_cache.contains(get_sam_cache_key(image_path)):
+            continue
+        image = cv2.imread(image_path)
+        if image is not None:
+            paths.append(image_path)
+            # RGB, as find_box_and_angle encodes it, so the store keys match
+            images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    if not images:
+        return {}
+    embeddings = get_predictor().encode_batch(images, batch_size=EMBED_BATCH_SIZE)
+    return dict(zip(paths, embeddings))
 
-def get_sam_bounding_box(image_path):
-    box, _ = get_sam_bounding_box_and_angle(image_path)
+def get_sam_bounding_box(image_path, mode="prompt"):
+    box, _ = get_sam_bounding_box_and_angle(image_path, mode=mode)
     return box
 
 def load_sam_predictor():
-    return mask_generator
\ No newline at end of file
+    return get_mask_generator()
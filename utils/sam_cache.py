@@ -0,0 +1,110 @@
+"""
+Content-addressed cache for SAM print-area results.
+
+Entries are keyed by a hash of the image file's bytes plus the parameters
+that affect the result, so re-uploads of the same image hit the cache and
+different images with the same file name don't collide. Masks are stored
+bit-packed, writes are atomic, and the directory is kept under a size
+budget by evicting least recently used entries.
+"""
+import functools
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import numpy as np
+
+CACHE_DIR = "cache/sam"
+MAX_CACHE_BYTES = int(os.getenv("SAM_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+
+# Bump when the stored format or the analysis itself changes
+CACHE_VERSION = 2
+
+def cache_key(image_path, params):
+    stat = os.stat(image_path)
+    h = hashlib.sha256(_file_digest(os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size))
+    h.update(json.dumps({"version": CACHE_VERSION, **params}, sort_keys=True).encode())
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize=1024)
+def _file_digest(image_path, mtime_ns, size):
+    # Hashed once per file version; mtime and size are only part of the memo key
+    h = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+def _entry_path(key, cache_dir):
+    return os.path.join(cache_dir, f"{key}.pkl")
+
+# Same bit layout as segment_anything.utils.amg.pack_masks, which needs torch;
+# app workers using the SAM server never import it.
+
+def pack_mask(mask):
+    """Bit-packs a HxW mask (any nonzero pixel is foreground), 8x smaller than uint8."""
+    if mask is None:
+        return None
+    return {"shape": mask.shape, "bits": np.packbits(mask > 0)}
+
+def unpack_mask(packed):
+    """Inverse of pack_mask; returns a uint8 mask with values 0 and 255."""
+    if packed is None:
+        return None
+    h, w = packed["shape"]
+    return np.unpackbits(packed["bits"], count=h * w).reshape(h, w) * np.uint8(255)
+
+def contains(key, cache_dir=CACHE_DIR):
+    return os.path.exists(_entry_path(key, cache_dir))
+
+def load(key, cache_dir=CACHE_DIR):
+    """
+    Returns the cached result for key, as passed to save, or None. A hit
+    marks the entry as recently used.
+    """
+    path = _entry_path(key, cache_dir)
+    try:
+        with open(path, "rb") as f:
+            entry = pickle.load(f)
+        os.utime(path)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+    return dict(entry, mask=unpack_mask(entry.get("mask")))
+
+def save(key, result, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """Atomically writes result (box, angle, mask), then evicts down to max_bytes."""
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = dict(result, mask=pack_mask(result.get("mask")))
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, _entry_path(key, cache_dir))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    evict(cache_dir, max_bytes)
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """Deletes least recently used entries until the cache fits in max_bytes."""
+    entries = []
+    for fname in os.listdir(cache_dir):
+        if not fname.endswith(".pkl"):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, fname))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, fname))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, fname in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, fname))
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,165 @@
+"""
+Local SAM inference server, so every app worker on a host shares one model.
+
+The server owns the only SAM model and embedding store. Requests from all
+connected clients are gathered for a few milliseconds, the images among
+them that still need an embedding are encoded in one batched encoder pass,
+and the prompts are then decoded concurrently on the shared predictor.
+
+Start it from the repo root, next to the app:
+
+    SAM_SERVER_ADDRESS=/tmp/inkd-sam.sock SAM_SERVER_AUTHKEY=<secret> python -m utils.sam_server
+
+and set the same SAM_SERVER_ADDRESS and SAM_SERVER_AUTHKEY for the Streamlit
+processes. Without SAM_SERVER_ADDRESS product_inspector_sam loads SAM
+in-process, as before. Requests and replies are pickled, so the socket is
+only readable by its owner and connections must present the authkey; there
+is no default one.
+"""
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+SERVER_ADDRESS = os.getenv("SAM_SERVER_ADDRESS")
+DEFAULT_SERVER_ADDRESS = "/tmp/inkd-sam.sock"
+AUTHKEY = os.getenv("SAM_SERVER_AUTHKEY")
+
+# How long the server waits for more requests to share an encoder pass
+BATCH_WINDOW_SECONDS = 0.02
+# Concurrent decodes; the predictor and mask generator are thread-safe
+DECODE_WORKERS = 2
+
+class RemoteError(Exception):
+    """An exception raised by a request on the server."""
+
+def _get_authkey():
+    if not AUTHKEY:
+        raise RuntimeError("SAM_SERVER_AUTHKEY must be set to use the SAM server")
+    return AUTHKEY.encode()
+
+# ---- Client ----
+
+def request(op, *args, address=None):
+    """
+    Sends one request to the server and returns its result. Raises OSError
+    or EOFError if the server can't be reached, AuthenticationError if it
+    rejects the authkey, and RemoteError if the request failed on the server.
+    """
+    with Client(address or SERVER_ADDRESS, family="AF_UNIX", authkey=_get_authkey()) as conn:
+        conn.send((op, args))
+        ok, result = conn.recv()
+    if not ok:
+        raise RemoteError(result)
+    return result
+
+# ---- Server ----
+
+def _run_batch(batch, decode_pool):
+    from utils import product_inspector_sam
+
+    # One encoder pass for every image in the batch without a cached result
+    image_paths = []
+    for op, args, _ in batch:
+        if op == "embed":
+            image_paths.extend(args[0])
+        elif op == "box_and_angle" and args[1] == "prompt":
+            image_paths.append(args[0])
+    try:
+        embeddings = product_inspector_sam.encode_product_images(list(dict.fromkeys(image_paths)))
+    except Exception as e:
+        for _, _, future in batch:
+            future.set_exception(e)
+        return
+
+    for op, args, future in batch:
+        if op == "embed":
+            future.set_result(None)
+        elif op == "box_and_angle":
+            image_path, mode = args
+            decode_pool.submit(
+                _resolve,
+                future,
+                product_inspector_sam.compute_sam_bounding_box_and_angle,
+                image_path,
+                mode,
+                embedding=embeddings.get(image_path),
+            )
+        else:
+            future.set_exception(ValueError(f"Unknown request {op}"))
+
+def _resolve(future, fn, *args, **kwargs):
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+
+def _batch_loop(requests, batch_size):
+    decode_pool = ThreadPoolExecutor(DECODE_WORKERS, thread_name_prefix="sam-decode")
+    while True:
+        batch = [requests.get()]
+        deadline = time.monotonic() + BATCH_WINDOW_SECONDS
+        while len(batch) < batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        _run_batch(batch, decode_pool)
+
+def _handle_connection(conn, requests):
+    with conn:
+        try:
+            op, args = conn.recv()
+        except EOFError:
+            return
+        future = Future()
+        requests.put((op, args, future))
+        try:
+            reply = (True, future.result())
+        except Exception as e:
+            # Sent as text, so the client can't mistake it for its own
+            # connection errors
+            reply = (False, f"{type(e).__name__}: {e}")
+        try:
+            conn.send(reply)
+        except OSError:
+            pass  # The client went away
+
+def serve(address=DEFAULT_SERVER_ADDRESS):
+    from utils import model_registry, product_inspector_sam
+
+    authkey = _get_authkey()
+    # Load and warm up the model before accepting connections
+    product_inspector_sam.warm_up_sam(model_registry.get("sam"))
+    model_registry.get("sam_predictor")
+    model_registry.get("sam_mask_generator")
+
+    if os.path.exists(address):
+        os.remove(address)
+    requests = queue.Queue()
+    threading.Thread(
+        target=_batch_loop,
+        args=(requests, product_inspector_sam.EMBED_BATCH_SIZE),
+        name="sam-batcher",
+        daemon=True,
+    ).start()
+
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+        os.chmod(address, 0o600)
+        print(f"[SAM-SERVER] Listening on {address}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:  # Failed handshake, e.g. a wrong authkey
+                print(f"[SAM-SERVER] Rejected connection: {e}")
+                continue
+            threading.Thread(target=_handle_connection, args=(conn, requests), daemon=True).start()
+
+if __name__ == "__main__":
+    serve(sys.argv[1] if len(sys.argv) > 1 else SERVER_ADDRESS or DEFAULT_SERVER_ADDRESS)